@@ -1,21 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging
+import os
+from collections import OrderedDict
 from multiprocessing import Pool, cpu_count
+from tempfile import TemporaryFile
+from threading import Lock
 from time import time
 
 import numpy as np
 from h5py import File
-from numpy.linalg import lstsq, pinv
 from scipy.interpolate import interp1d
-from scipy.linalg import cholesky, solve_triangular
+from scipy.linalg import (LinAlgError, cho_solve, cholesky, eigh, hadamard,
+                          solve_triangular)
+from scipy.sparse import csc_matrix, csr_matrix, diags
+from scipy.sparse.linalg import splu
 from skimage.restoration import unwrap_phase
 from zernike import RZern
 
 from dmlib.core import SquareRoot, h5_read_str, h5_store_str
 from dmlib.dmplot import DMPlot
 from dmlib.interf import FringeAnalysis
+from dmlib.linalg import SPDSolver, cached, fwht, pseudo_inverse
 
 LOG = logging.getLogger('calibration')
 HDF5_options = {
@@ -26,6 +34,102 @@ HDF5_options = {
     'compression_opts': 6
 }
 
+# interval between saves of a PhaseCheckpoint [s]
+CHECKPOINT_INTERVAL = 5.
+# number of apertures kept for each dataset in a PhaseCheckpoint file
+PHASE_CACHE_SIZE = 4
+# bytes of the Zernike Cartesian grids kept in memory, see set_cart_grid()
+CART_CACHE_BYTES = 2**30
+# directory for the Zernike Cartesian grids shared between processes, if any
+CART_CACHE_DIR = os.environ.get('DMLIB_CART_CACHE', None)
+
+_cart_grids = OrderedDict()
+_cart_grids_lock = Lock()
+
+
+def cart_grid_key(cart, xx, yy):
+    "Key of the Cartesian grid of the `RZern` `cart` on `xx` and `yy`"
+    h = hashlib.sha256()
+    h.update(f'{cart.n} {cart.numpy_dtype} {xx.shape}'.encode())
+    h.update(np.ascontiguousarray(xx, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(yy, dtype=float).tobytes())
+    return h.hexdigest()[:32]
+
+
+def set_cart_grid(cart, xx, yy):
+    """Make the Cartesian grid of an `RZern` as `cart.make_cart_grid(xx, yy)`.
+
+    The grids are computed once for each `n_radial`, `xx` and `yy` and the
+    most recently used are shared, read-only, by all the `RZern` objects of
+    the process, up to `CART_CACHE_BYTES` in memory. Larger grids are not
+    cached. If `CART_CACHE_DIR` is set, e.g., with the environment variable
+    `DMLIB_CART_CACHE`, the grids are also saved there as `.npy` files that
+    are memory-mapped, so that they are shared between processes and
+    sessions. Memory-mapped grids do not count towards `CART_CACHE_BYTES`.
+
+    """
+    key = cart_grid_key(cart, xx, yy)
+    with _cart_grids_lock:
+        ZZ = _cart_grids.get(key)
+        if ZZ is not None:
+            _cart_grids.move_to_end(key)
+
+    if ZZ is None:
+        # computed without holding the lock, which would block the callers
+        # of other grids meanwhile
+        ZZ = _load_cart_grid(cart, xx, yy, key)
+        with _cart_grids_lock:
+            if key in _cart_grids:
+                ZZ = _cart_grids[key]
+                _cart_grids.move_to_end(key)
+            elif _cart_grid_bytes(ZZ) <= CART_CACHE_BYTES:
+                _cart_grids[key] = ZZ
+                while sum(_cart_grid_bytes(a)
+                          for a in _cart_grids.values()) > CART_CACHE_BYTES:
+                    _cart_grids.popitem(last=False)
+    cart.ZZ = ZZ
+    cart.shape = xx.shape
+    return cart
+
+
+def _cart_grid_bytes(ZZ):
+    if isinstance(ZZ, np.memmap):
+        return 0
+    else:
+        return ZZ.nbytes
+
+
+def _load_cart_grid(cart, xx, yy, key):
+    fname = None
+    if CART_CACHE_DIR:
+        fname = os.path.join(CART_CACHE_DIR, f'rzern-{key}.npy')
+        try:
+            ZZ = np.load(fname, mmap_mode='r')
+            if ZZ.shape == (xx.size, cart.nk):
+                return ZZ
+        except (OSError, ValueError):
+            pass
+
+    t1 = time()
+    cart.make_cart_grid(xx, yy)
+    ZZ = cart.ZZ
+    LOG.debug(f'set_cart_grid(): {cart.n} {xx.shape} {time() - t1:.3f}')
+
+    if fname is not None:
+        try:
+            os.makedirs(CART_CACHE_DIR, exist_ok=True)
+            tmp = f'{fname}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, ZZ)
+            os.replace(tmp, fname)
+            return np.load(fname, mmap_mode='r')
+        except OSError:
+            LOG.warning(f'set_cart_grid(): cannot save {fname}',
+                        exc_info=True)
+
+    ZZ.flags.writeable = False
+    return ZZ
+
 
 def u2v(u, vmin, vmax, sqrt=False):
     u = np.array(u, copy=True)
@@ -59,24 +163,185 @@ def make_normalised_input_matrix(nacts, nsteps, mag):
                                          nsteps)), np.zeros((nacts, 1))))
 
 
-def fix_principal_val(U, phases):
+def add_reference_frames(U, every):
+    """Insert a zero input every `every` frames of `U`.
+
+    The zero inputs are the nodes used by `fix_principal_val()`, so the
+    first and the last frames are always zero.
+
+    """
+    if every < 1:
+        raise ValueError('every < 1')
+    cols = [np.zeros((U.shape[0], 1))]
+    for a in range(0, U.shape[1], every):
+        cols.append(U[:, a:a + every])
+        cols.append(np.zeros((U.shape[0], 1)))
+    return np.hstack(cols)
+
+
+def _push_pull(Up, every):
+    # follow each frame by its opposite and add the reference frames
+    Up = np.stack((Up, -Up), axis=2).reshape(Up.shape[0], 2 * Up.shape[1])
+    return add_reference_frames(Up, every)
+
+
+class HadamardDesign:
+    """Push-pull Hadamard input design.
+
+    Each frame pokes all the actuators with a magnitude of `mag` and the
+    signs of a column of a Hadamard matrix of order `n`, the smallest power
+    of two larger than `nacts`, and is followed by its opposite. This gives
+    `2n` frames plus the reference frames (see `add_reference_frames()`),
+    instead of the `nacts*nsteps + 2` of `make_normalised_input_matrix()`.
+
+    The constant row is skipped, the signs of the rows are randomised and
+    the columns are shuffled, so that no frame pokes large groups of
+    neighbouring actuators with the same sign. The rows stay orthogonal, so
+    that `U @ U.T` is diagonal. Since the phases of all the actuators add
+    up, `mag` must be smaller than for single pokes.
+
+    The phases are demultiplexed into the influence phases of the
+    actuators with a fast Walsh-Hadamard transform, see `demultiplex()`.
+
+    """
+    def __init__(self, nacts, mag, every=16, seed=0):
+        n = 1 << int(np.ceil(np.log2(nacts + 1)))
+        rng = np.random.default_rng(seed)
+        self.nacts = nacts
+        self.mag = mag
+        self.every = every
+        self.seed = seed
+        self.signs = rng.choice((-1., 1.), size=nacts)
+        self.perm = rng.permutation(n)
+
+        Hd = self.signs.reshape(-1, 1) * hadamard(n)[1:nacts + 1, self.perm]
+        self.U = _push_pull(mag * Hd, every)
+
+        # indices in U of the push and pull frames
+        frames = np.where(np.square(self.U).sum(axis=0) > 1e-6)[0]
+        assert (frames.size == 2 * n)
+        self.push = frames[0::2]
+        self.pull = frames[1::2]
+
+    def order(self):
+        return self.perm.size
+
+    def demultiplex(self, phases, blocksize=4096):
+        """Compute `U @ phases` with a fast Walsh-Hadamard transform.
+
+        Returns an `nacts x nphi` array that is the transpose of the
+        `phiiuiT` normal matrix of `RegLSCalib.calibrate()`. `phases` are
+        read in blocks of `blocksize` pixels.
+
+        """
+        n = self.order()
+        nphi = phases.shape[1]
+        out = np.empty((self.nacts, nphi))
+        X = np.empty((n, min(blocksize, nphi)))
+        for a in range(0, nphi, blocksize):
+            b = min(a + blocksize, nphi)
+            Xb = X[:, :b - a]
+            if not Xb.flags.c_contiguous:
+                Xb = np.empty((n, b - a))
+            # undo the shuffle of the columns
+            Xb[self.perm] = phases[self.push, a:b] - phases[self.pull, a:b]
+            fwht(Xb)
+            out[:, a:b] = Xb[1:self.nacts + 1]
+        out *= self.mag * self.signs.reshape(-1, 1)
+        return out
+
+    @classmethod
+    def load_h5py(cls, f, prepend=None):
+        """Load object contents from an opened HDF5 file object."""
+        prefix = cls.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        z = cls(int(f[prefix + 'nacts'][()]), float(f[prefix + 'mag'][()]),
+                int(f[prefix + 'every'][()]), int(f[prefix + 'seed'][()]))
+        assert (np.allclose(z.perm, f[prefix + 'perm'][()]))
+        return z
+
+    def save_h5py(self, f, prepend=None):
+        """Dump object contents into an opened HDF5 file object."""
+        prefix = self.__class__.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        f[prefix + 'nacts'] = self.nacts
+        f[prefix + 'mag'] = self.mag
+        f[prefix + 'every'] = self.every
+        f[prefix + 'seed'] = self.seed
+        f[prefix + 'perm'] = self.perm
+
+
+def make_hadamard_input_matrix(nacts, mag, every=16, seed=0):
+    "Input matrix of a `HadamardDesign`"
+    return HadamardDesign(nacts, mag, every, seed).U
+
+
+def make_random_input_matrix(nacts, nframes, mag, every=16, seed=None):
+    """Push-pull random input design.
+
+    Each of the `nframes` frames pokes all the actuators with a magnitude of
+    `mag` and random signs, and is followed by its opposite. `nframes`
+    should be at least `nacts`. See `make_hadamard_input_matrix()`.
+
+    """
+    if nframes < nacts:
+        raise ValueError('nframes < nacts')
+    rng = np.random.default_rng(seed)
+    return _push_pull(mag * rng.choice((-1., 1.), size=(nacts, nframes)),
+                      every)
+
+
+def is_single_poke(U):
+    "True if each frame of `U` pokes at most one actuator"
+    return bool(np.all(np.count_nonzero(U, axis=0) <= 1))
+
+
+def row_blocks(n, blocksize):
+    "Slices of at most `blocksize` rows covering `n` rows"
+    for a in range(0, n, blocksize):
+        yield slice(a, min(a + blocksize, n))
+
+
+def row_means(phases, blocksize=64):
+    "Mean of each row of `phases` computed in blocks of `blocksize` rows"
+    means = np.empty(phases.shape[0])
+    for s in row_blocks(phases.shape[0], blocksize):
+        means[s] = np.mean(phases[s], axis=1)
+    return means
+
+
+def fix_principal_val(U, phases, blocksize=64):
+    """Remove the 2pi ambiguity of the piston of each phase.
+
+    The mean of the phases with a zero input (nodes) is unwrapped and
+    interpolated across all frames. Each phase is then shifted by a
+    multiple of 2pi to be close to the interpolated piston, and the
+    interpolated piston is removed. `phases` is modified in place in blocks
+    of `blocksize` rows, so that it can be an HDF5 dataset or a memory map.
+    Returns the indices of the nodes.
+
+    """
     ns = phases.shape[0]
     norms = np.square(U).sum(axis=0)
     assert (norms.size == ns)
     inds = np.where(norms <= 1e-6)[0]
 
-    nodes0 = [phases[i, :].mean() for i in inds]
-    nodes1 = unwrap_phase(np.array(nodes0))
-    pistons1 = phases.mean(axis=1)
+    pistons1 = row_means(phases, blocksize)
+    nodes1 = unwrap_phase(pistons1[inds])
 
     xq = np.linspace(-1, 1, ns)
     yq = interp1d(xq[inds], nodes1, copy=False, assume_sorted=True)(xq)
 
-    pistons2 = np.zeros_like(pistons1)
-    for i in range(ns):
-        k = round((yq[i] - pistons1[i]) / (2 * np.pi))
-        pistons2[i] = pistons1[i] + 2 * k * np.pi - yq[i]
-    phases += (pistons2 - pistons1).reshape(-1, 1)
+    k = np.round((yq - pistons1) / (2 * np.pi))
+    delta = 2 * np.pi * k - yq
+    for s in row_blocks(ns, blocksize):
+        phases[s] += delta[s].reshape(-1, 1)
 
     return inds
 
@@ -93,20 +358,436 @@ class PhaseExtract:
         return unwrapped[self.mask]
 
 
+# PhaseExtract of the processes in a pool made by make_phase_pool()
+_phase_extract = None
+
+
+def _init_phase_extract(fringe):
+    global _phase_extract
+    _phase_extract = PhaseExtract(fringe)
+
+
+def extract_phase(img):
+    "Extract a phase in a process of a pool made by `make_phase_pool()`"
+    return _phase_extract(img)
+
+
+def make_phase_pool(fringe, processes=None):
+    """Make a process pool to extract phases with `extract_phase()`.
+
+    The fringe analysis is sent to each process once, so that single
+    images can be submitted as they are acquired.
+
+    """
+    return Pool(processes, _init_phase_extract, (fringe, ))
+
+
+class NormalMatrices:
+    """Accumulate the least-squares matrices of `RegLSCalib.calibrate()`.
+
+    Phases can be added one at a time as they are extracted. Inputs with
+    a zero norm are skipped as in `calibrate()`. The piston and reference
+    phase corrections are applied by `calibrate()`.
+
+    """
+    def __init__(self, nu, nphi):
+        self.uiuiT = np.zeros((nu, nu))
+        self.phiiuiT = np.zeros((nphi, nu))
+        self.count = 0
+
+    def add(self, u, phi):
+        if np.square(u).sum() > 1e-6:
+            self.uiuiT += np.outer(u, u)
+            self.phiiuiT += np.outer(phi, u)
+        self.count += 1
+
+    @classmethod
+    def load_h5py(cls, f, prepend=None):
+        """Load object contents from an opened HDF5 file object."""
+        prefix = cls.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        z = cls(*f[prefix + 'phiiuiT'].shape[::-1])
+        z.uiuiT = f[prefix + 'uiuiT'][()]
+        z.phiiuiT = f[prefix + 'phiiuiT'][()]
+        z.count = int(f[prefix + 'count'][()])
+        return z
+
+    def save_h5py(self, f, prepend=None):
+        """Dump object contents into an opened HDF5 file object."""
+        prefix = self.__class__.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        f[prefix + 'uiuiT'] = self.uiuiT
+        f[prefix + 'phiiuiT'] = self.phiiuiT
+        f[prefix + 'count'] = self.count
+
+
+def vaf(y, ye):
+    "Variance accounted for [%] along the rows of `y` by `ye`"
+    return 100 * (1 - np.var(y - ye, axis=1) / np.var(y, axis=1))
+
+
+def chunked_vaf(phases, zfA1, HU, blocksize=4096):
+    """Same as `vaf(phases.T, zfA1 @ HU)` computed in blocks of pixels.
+
+    This avoids the `nphi x ns` temporary of the predicted phases.
+
+    """
+    nphi = phases.shape[1]
+    out = np.empty(nphi)
+    for a in range(0, nphi, blocksize):
+        b = min(a + blocksize, nphi)
+        out[a:b] = vaf(phases[:, a:b].T, np.dot(zfA1[a:b], HU))
+    return out
+
+
+def cross_validated_vaf(U, phases, zfA1, inds1, phiiuiT, uiuiT, folds=4):
+    """K-fold cross-validated VAF of a `RegLSCalib` calibration.
+
+    The frames `inds1` are split into `folds` interleaved folds. For each
+    fold the contributions of its frames are subtracted from the normal
+    matrices `phiiuiT` and `uiuiT`, and the fitted model predicts the held
+    out frames. Only the Zernike coefficients of the phases are needed to
+    downdate the normal matrices, so the phases are not fitted again.
+    Returns the per-pixel VAF of the held out predictions, which is
+    comparable to the in-sample `mvaf`.
+
+    The downdated `uiuiT` of each fold is factorised again from scratch,
+    i.e., `folds` Cholesky factorisations of `nu x nu` matrices, for `nu`
+    actuators. Each fold removes about `ns / folds` frames, so a sequence of
+    rank-one downdates of a single factorisation would cost `ns / folds`
+    times `nu**2` instead of `nu**3 / 3` per fold, which is no cheaper for
+    the usual designs with `ns` a small multiple of `nu`.
+
+    """
+    ns = U.shape[1]
+    R = cholesky(np.dot(zfA1.T, zfA1), lower=False)
+
+    def zfit(X):
+        Y = solve_triangular(R, np.dot(zfA1.T, X), trans='T', lower=False)
+        return solve_triangular(R, Y, trans='N', lower=False)
+
+    # Zernike coefficients of the phases and of the normal matrix
+    Zp = np.zeros((zfA1.shape[1], ns))
+    for s in row_blocks(ns, 64):
+        Zp[:, s] = zfit(phases[s].T)
+    Zp = Zp[:, inds1]
+    M = zfit(phiiuiT)
+
+    fold = np.arange(inds1.size) % folds
+    HU = np.zeros((zfA1.shape[1], ns))
+    for j in range(folds):
+        sel = fold == j
+        Uf = U[:, inds1[sel]]
+        Bf = uiuiT - np.dot(Uf, Uf.T)
+        Mf = M - np.dot(Zp[:, sel], Uf.T)
+        Hf = SPDSolver(Bf, f'cross_validated_vaf() {j}').solve(Mf.T).T
+        HU[:, inds1[sel]] = np.dot(Hf, Uf)
+
+    return chunked_vaf(phases, zfA1, HU)
+
+
+def phases_key(hash1, fringe):
+    "Key of the phases extracted from a dataset with a fringe analysis"
+    hasher = hashlib.sha256(hash1.encode())
+    for a in (fringe.shape, fringe.P, fringe.fxcfyc, fringe.centre,
+              fringe.radius):
+        hasher.update(np.asarray(a, dtype=float).tobytes())
+    return hasher.hexdigest()
+
+
+def repack_h5(fname, keep):
+    """Rewrite the HDF5 file `fname` with only the groups in `keep`.
+
+    HDF5 does not reclaim the space of deleted objects, so the file is
+    copied instead of deleting the other groups in place.
+
+    """
+    tmp = fname + '.tmp'
+    with File(fname, 'r') as f, File(tmp, 'w') as f2:
+        for k in keep:
+            f.copy(f[k], f2, name=k)
+    os.replace(tmp, fname)
+
+
+class PhaseCheckpoint:
+    """Phases extracted so far from a dataset, kept in a sidecar HDF5 file.
+
+    Each dataset and aperture is stored in a group named after
+    `phases_key()`. The group holds the phases within the aperture, a flag
+    for each frame that is done and the `NormalMatrices` accumulated from
+    the done frames, which are saved at most every `CHECKPOINT_INTERVAL`
+    seconds.
+
+    The file can be kept as a cache of the phases. Groups of a different
+    `hash1` are dropped, as are the least recently used groups beyond
+    `PHASE_CACHE_SIZE`.
+
+    """
+    def __init__(self, fname, key, U, nphi, hash1=''):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.fname = fname
+        self.key = key
+        self.U = U
+        self.f = File(fname, 'a')
+        self._prune(hash1)
+
+        ns = U.shape[1]
+        g = self.f.get(key)
+        if g is not None and g['phases'].shape != (ns, nphi):
+            del self.f[key]
+            g = None
+        if g is None:
+            g = self.f.create_group(key)
+            g.create_dataset('phases', (ns, nphi),
+                             dtype=float,
+                             chunks=(1, nphi))
+            g['done'] = np.zeros(ns, dtype=bool)
+            NormalMatrices(U.shape[0], nphi).save_h5py(g)
+            g.attrs['hash1'] = hash1
+        g.attrs['used'] = time()
+        self.f.flush()
+        self.g = g
+        self.done = g['done'][()]
+        self.normal = NormalMatrices.load_h5py(g)
+        if self.normal.count != self.done.sum():
+            self.log.warning(f'{fname} {key} is inconsistent')
+            self.done[:] = False
+            self.normal = NormalMatrices(U.shape[0], nphi)
+        self.last = time()
+
+    def _prune(self, hash1):
+        keys = [k for k in self.f if self.f[k].attrs.get('hash1') != hash1]
+        used = sorted((self.f[k].attrs.get('used', 0.), k) for k in self.f
+                      if k not in keys and k != self.key)
+        keys += [k for _, k in used[:max(0, len(used) - PHASE_CACHE_SIZE + 1)]]
+        if keys:
+            for k in keys:
+                self.log.info(f'dropping {self.fname} {k}')
+            keep = [k for k in self.f if k not in keys]
+            self.f.close()
+            repack_h5(self.fname, keep)
+            self.f = File(self.fname, 'a')
+
+    def todo(self):
+        return np.where(np.invert(self.done))[0]
+
+    def add(self, i, phi):
+        self.g['phases'][i, :] = phi
+        self.normal.add(self.U[:, i], phi)
+        self.done[i] = True
+        if time() - self.last > CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        prefix = 'NormalMatrices/'
+        self.g[prefix + 'uiuiT'][...] = self.normal.uiuiT
+        self.g[prefix + 'phiiuiT'][...] = self.normal.phiiuiT
+        self.g[prefix + 'count'][()] = self.normal.count
+        self.g['done'][...] = self.done
+        self.f.flush()
+        self.last = time()
+
+    def get_phases(self):
+        return self.g['phases'][()]
+
+    def close(self):
+        self.f.close()
+
+    def remove(self):
+        "Drop the group of this checkpoint and the file if it is left empty"
+        with File(self.fname, 'r') as f:
+            keep = [k for k in f if k != self.key]
+        if keep:
+            repack_h5(self.fname, keep)
+        else:
+            os.remove(self.fname)
+
+
+def make_binning_matrix(mask, factor):
+    """Sparse matrix averaging the aperture pixels in blocks.
+
+    `mask` is a boolean image that is true inside the aperture. The rows of
+    the returned matrix average the aperture pixels, in the order of
+    `phi[mask]`, of each `factor x factor` block that contains any. Blocks
+    across the rim of the aperture are averaged over their own pixel count.
+
+    """
+    yy, xx = np.nonzero(mask)
+    nbx = (mask.shape[1] + factor - 1) // factor
+    block = (yy // factor) * nbx + xx // factor
+    _, rows = np.unique(block, return_inverse=True)
+    counts = np.bincount(rows)
+    return csr_matrix((1 / counts[rows], (rows, np.arange(rows.size))),
+                      shape=(counts.size, rows.size))
+
+
+class SparseInfluence:
+    """Influence functions of the actuators as sparse patches.
+
+    The influence function of each actuator is kept only within `support`
+    actuator pitches of its centre in the pupil, giving a sparse `nphi x
+    nu` matrix `S` of the phase in the aperture per unit input. `forward()`
+    and `control()` are then sparse products, which are much cheaper than
+    the dense Zernike model for DMs with many actuators.
+
+    The centres are the `DMPlot` locations mapped into the unit aperture
+    with the affine transform that best fits the peaks of the influence
+    functions, or the peaks themselves if the locations are not known.
+
+    """
+    def __init__(self, S, centres, pitch, support):
+        self.S = csc_matrix(S)
+        self.centres = centres
+        self.pitch = pitch
+        self.support = support
+        self.factorisations = {}
+
+    @classmethod
+    def fit(cls, influence, xy, locations=None, support=2.5, blocksize=4096):
+        """Extract the patches from dense influence functions.
+
+        `influence(s)` returns the influence functions of all the actuators
+        on the pixels in the slice `s`, as an `nu x npixels` array. `xy` are
+        the `nphi x 2` coordinates of the pixels in the unit aperture. The
+        pixels are processed in blocks of `blocksize`.
+
+        """
+        nphi = xy.shape[0]
+
+        # peak of each influence function
+        peaks = None
+        for s in row_blocks(nphi, blocksize):
+            Fb = np.abs(influence(s))
+            if peaks is None:
+                peaks = np.zeros(Fb.shape[0])
+                inds = np.zeros(Fb.shape[0], dtype=int)
+            amax = Fb.argmax(axis=1)
+            vmax = Fb[np.arange(Fb.shape[0]), amax]
+            better = vmax > peaks
+            peaks[better] = vmax[better]
+            inds[better] = amax[better] + s.start
+        centres = xy[inds]
+        nu = centres.shape[0]
+
+        if locations is not None:
+            # fit the affine transform with the actuators well inside the
+            # aperture
+            sel = np.logical_and(
+                np.sqrt(np.square(centres).sum(axis=1)) < .9,
+                peaks > .5 * np.median(peaks))
+            if sel.sum() >= 3:
+                L = np.hstack((locations, np.ones((nu, 1))))
+                T = np.linalg.lstsq(L[sel], centres[sel], rcond=None)[0]
+                centres = np.dot(L, T)
+            else:
+                LOG.warning('SparseInfluence: too few actuators to map ' +
+                            'the locations, using the peaks')
+
+        dists = np.sqrt(
+            np.square(centres.reshape(-1, 1, 2) -
+                      centres.reshape(1, -1, 2)).sum(axis=2))
+        dists[np.arange(nu), np.arange(nu)] = np.inf
+        pitch = np.median(dists.min(axis=1))
+
+        rows, cols, vals = [], [], []
+        radius2 = (support * pitch)**2
+        for s in row_blocks(nphi, blocksize):
+            Fb = influence(s)
+            d2 = (np.square(xy[s, 0].reshape(1, -1) - centres[:, [0]]) +
+                  np.square(xy[s, 1].reshape(1, -1) - centres[:, [1]]))
+            act, pix = np.nonzero(d2 < radius2)
+            rows.append(pix + s.start)
+            cols.append(act)
+            vals.append(Fb[act, pix])
+        S = csc_matrix(
+            (np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+            shape=(nphi, nu))
+        LOG.info(f'SparseInfluence: {S.nnz / (nphi * nu) * 100:.1f}% ' +
+                 'non-zeros')
+
+        return cls(S, centres, pitch, support)
+
+    def nactuators(self):
+        return self.S.shape[1]
+
+    def forward(self, u):
+        "Phase in the aperture for the input `u`"
+        return self.S @ u
+
+    def control(self, phi, lambda1=1e-3):
+        """Input that best produces the phase `phi` in the aperture.
+
+        Solves the normal equations of the least-squares with a Tikhonov
+        term scaled by `lambda1`. The sparse factorisation is cached for
+        each `lambda1`.
+
+        """
+        def factorise():
+            M = (self.S.T @ self.S).tocsc()
+            M = M + diags(np.full(M.shape[0], lambda1 * M.diagonal().mean()))
+            return splu(M.tocsc())
+
+        lu = cached(self, ('splu', lambda1), factorise)
+        return lu.solve(self.S.T @ phi)
+
+    @classmethod
+    def load_h5py(cls, f, prepend=None):
+        """Load object contents from an opened HDF5 file object."""
+        prefix = cls.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        S = csc_matrix((f[prefix + 'data'][()], f[prefix + 'indices'][()],
+                        f[prefix + 'indptr'][()]),
+                       shape=tuple(f[prefix + 'shape'][()]))
+        return cls(S, f[prefix + 'centres'][()],
+                   float(f[prefix + 'pitch'][()]),
+                   float(f[prefix + 'support'][()]))
+
+    def save_h5py(self, f, prepend=None, params=HDF5_options):
+        """Dump object contents into an opened HDF5 file object."""
+        prefix = self.__class__.__name__ + '/'
+
+        if prepend is not None:
+            prefix = prepend + prefix
+
+        for name in ('data', 'indices', 'indptr'):
+            params['data'] = getattr(self.S, name)
+            f.create_dataset(prefix + name, **params)
+        f[prefix + 'shape'] = self.S.shape
+        f[prefix + 'centres'] = self.centres
+        f[prefix + 'pitch'] = self.pitch
+        f[prefix + 'support'] = self.support
+
+
 class RegLSCalib:
     """Compute a DM calibration using regularised least-squares."""
     def __init__(self):
         self.zfA1 = None
         self.zfA2 = None
+        self.stds = None
+        self.cvvaf = None
+        self.sparse = None
+        self.pupil_bin = 1
+        self.zfB = None
+        self.zfA1f = None
+        self.factorisations = {}
 
     def _make_zfAs(self):
         if not hasattr(self.cart, 'ZZ'):
             xx, yy, _ = self.fringe.get_unit_aperture()
-            self.cart.make_cart_grid(xx, yy)
+            set_cart_grid(self.cart, xx, yy)
 
         mask = np.invert(self.zfm)
         zfA1 = np.zeros((self.zfm.sum(), self.cart.nk))
-        zfA2 = np.zeros_like(self.cart.ZZ)
+        zfA2 = np.zeros(self.cart.ZZ.shape)
         for i in range(zfA1.shape[1]):
             tmp = self.cart.matrix(self.cart.ZZ[:, i])
             zfA1[:, i] = tmp[self.zfm].ravel()
@@ -114,7 +795,18 @@ class RegLSCalib:
 
         self.zfA1 = zfA1
         self.zfA2 = zfA2
-        self.zfA1TzfA1 = np.dot(zfA1.T, zfA1)
+        # Zernike polynomials used for fitting, possibly on a binned pupil
+        if self.pupil_bin > 1:
+            self.zfB = make_binning_matrix(self.zfm, self.pupil_bin)
+            if self.zfB.shape[0] < zfA1.shape[1]:
+                raise ValueError(
+                    f'pupil_bin {self.pupil_bin} leaves {self.zfB.shape[0]} ' +
+                    f'pixels for {zfA1.shape[1]} Zernike polynomials')
+            self.zfA1f = np.asarray(self.zfB @ zfA1)
+        else:
+            self.zfB = None
+            self.zfA1f = zfA1
+        self.zfA1TzfA1 = np.dot(self.zfA1f.T, self.zfA1f)
         self.chzfA1TzfA1 = cholesky(self.zfA1TzfA1, lower=False)
 
         return zfA1, zfA2, mask
@@ -134,10 +826,65 @@ class RegLSCalib:
                   n_radial=25,
                   alpha=.75,
                   lambda1=5e-3,
-                  status_cb=False):
+                  status_cb=False,
+                  phases=None,
+                  normal=None,
+                  checkpoint=None,
+                  keep_checkpoint=False,
+                  cv_folds=4,
+                  scratch=None,
+                  blocksize=64,
+                  design=None,
+                  sparse_support=0.,
+                  pupil_bin=1):
+        """Compute the calibration.
+
+        Precomputed `phases`, as returned by `PhaseExtract`, skip the fringe
+        analysis of `images`. `NormalMatrices` accumulated from the same
+        phases further skip computing the least-squares matrices.
+
+        If `checkpoint` is the name of an HDF5 file, the phases are saved
+        there while they are computed (see `PhaseCheckpoint`) and a
+        calibration that was interrupted resumes from the frames already
+        done. The checkpoint is removed once the calibration is complete,
+        unless `keep_checkpoint` is set to reuse the phases in calibrations
+        with other `n_radial`, `alpha` or `lambda1`.
+
+        Besides the in-sample `mvaf`, a `cv_folds`-fold cross-validated
+        `cvvaf` is computed (see `cross_validated_vaf()`) if `cv_folds > 1`.
+
+        `U` can be any design with zero reference frames for
+        `fix_principal_val()`, such as `make_hadamard_input_matrix()` or
+        `make_random_input_matrix()`, where each frame pokes many actuators.
+        The influence functions are then the least-squares solution for all
+        the frames at once. If `U` is the input matrix of the `HadamardDesign`
+        `design`, the normal matrix of the phases is computed by
+        demultiplexing them with a fast Walsh-Hadamard transform.
+
+        The phases are an `ns x nphi` array that can be very large for DMs
+        with many actuators. If `scratch` is a directory, they are kept in a
+        `numpy.memmap` backed by a temporary file in that directory, which is
+        deleted when closed, whether or not the calibration succeeds. All
+        the steps operate on blocks of `blocksize` rows or on blocks of
+        pixels, so that the phases are never loaded whole.
+
+        If `sparse_support > 0`, a `SparseInfluence` model with patches of
+        that many actuator pitches is also computed as `sparse`.
+
+        If `pupil_bin > 1`, the phases are averaged in `pupil_bin x
+        pupil_bin` blocks of pixels (see `make_binning_matrix()`) once the
+        least-squares matrices are computed. The fit of the influence
+        matrix, the VAF, the regularisation weights, the sparse model and
+        the later `zernike_fit()` calls then work on the binned pupil. See
+        `binning_report()` for the effect on the Zernike coefficients.
+
+        """
 
         if dmplot is not None and U.shape[0] != dmplot.size():
             raise ValueError('U.shape[0] != dmplot.size()')
+        if design is not None and (design.U.shape != U.shape
+                                   or not np.allclose(design.U, U)):
+            raise ValueError('U is not the input matrix of design')
 
         if status_cb:
             status_cb('Computing Zernike polynomials ...')
@@ -146,8 +893,7 @@ class RegLSCalib:
         xx, yy, shape = fringe.get_unit_aperture()
         assert (xx.shape == shape)
         assert (yy.shape == shape)
-        cart = RZern(n_radial)
-        cart.make_cart_grid(xx, yy)
+        cart = set_cart_grid(RZern(n_radial), xx, yy)
         LOG.info(
             f'calibrate(): Computing Zernike polynomials {time() - t1:.1f}')
 
@@ -157,6 +903,7 @@ class RegLSCalib:
         zfm = cart.matrix(np.isfinite(cart.ZZ[:, 0]))
         self.cart = cart
         self.zfm = zfm
+        self.pupil_bin = pupil_bin
         zfA1, zfA2, mask = self._make_zfAs()
         LOG.info(f'calibrate(): Computing masks {time() - t1:.1f}')
 
@@ -165,9 +912,12 @@ class RegLSCalib:
         assert (np.allclose(mask, mask1))
         assert (np.allclose(fringe.mask, mask1))
 
-        if status_cb:
-            status_cb('Computing phases 00.00% ...')
         t1 = time()
+        nphi = np.invert(fringe.mask).sum()
+        if phases is not None and phases.shape != (ns, nphi):
+            raise ValueError('phases.shape != (U.shape[1], nphi)')
+        elif phases is None and status_cb:
+            status_cb('Computing phases 00.00% ...')
 
         def make_progress():
             prevts = [time()]
@@ -181,41 +931,102 @@ class RegLSCalib:
 
             return f
 
-        with Pool() as p:
-            if status_cb:
-                chunksize = ns // (4 * cpu_count())
-                if chunksize < 4:
-                    chunksize = 4
-                phases = []
-                progress_fun = make_progress()
+        # the phases are modified in place, so they are always copied into
+        # a new array, possibly backed by a file
+        if scratch is not None:
+            scratch_file = TemporaryFile(suffix='-scratch.dat', dir=scratch)
+            phases1 = np.memmap(scratch_file, float, 'w+', shape=(ns, nphi))
+        else:
+            phases1 = np.empty((ns, nphi))
+
+        ckpt = None
+        if phases is not None:
+            for s in row_blocks(ns, blocksize):
+                phases1[s] = phases[s]
+        elif checkpoint is not None:
+            ckpt = PhaseCheckpoint(checkpoint, phases_key(hash1, fringe), U,
+                                   nphi, hash1)
+            todo = ckpt.todo()
+            LOG.info(f'calibrate(): {checkpoint} {ns - todo.size}/{ns} done')
+            try:
+                if todo.size > 0:
+                    with Pool() as p:
+                        chunksize = max(4, todo.size // (4 * cpu_count()))
+                        if status_cb:
+                            progress_fun = make_progress()
+                        for j, phi in enumerate(
+                                p.imap(PhaseExtract(fringe),
+                                       (images[i, ...] for i in todo),
+                                       chunksize)):
+                            ckpt.add(todo[j], phi)
+                            if status_cb:
+                                progress_fun(100 * (ns - todo.size + j + 1) /
+                                             ns)
+                    ckpt.save()
+                for s in row_blocks(ns, blocksize):
+                    phases1[s] = ckpt.g['phases'][s]
+                normal = ckpt.normal
+            finally:
+                ckpt.close()
+        else:
+            with Pool() as p:
+                chunksize = max(4, ns // (4 * cpu_count()))
+                if status_cb:
+                    progress_fun = make_progress()
                 for i, phi in enumerate(
                         p.imap(PhaseExtract(fringe),
-                               [images[i, ...] for i in range(ns)], chunksize),
-                        1):
-                    phases.append(phi)
-                    progress_fun(100 * i / ns)
-            else:
-                phases = p.map(PhaseExtract(fringe),
-                               [images[i, ...] for i in range(ns)])
-            phases = np.array(phases)
-
-        inds0 = fix_principal_val(U, phases)
+                               (images[i, ...] for i in range(ns)),
+                               chunksize)):
+                    phases1[i] = phi
+                    if status_cb:
+                        progress_fun(100 * (i + 1) / ns)
+        phases = phases1
+
+        means = row_means(phases, blocksize)
+        inds0 = fix_principal_val(U, phases, blocksize)
         inds1 = np.setdiff1d(np.arange(ns), inds0)
         assert (np.allclose(np.arange(ns), np.sort(np.hstack((inds0, inds1)))))
-        phi0 = phases[inds0, :].mean(axis=0)
-        z0 = lstsq(np.dot(zfA1.T, zfA1), np.dot(zfA1.T, phi0), rcond=None)[0]
-        phases -= phi0.reshape(1, -1)
+        phi0 = np.zeros(nphi)
+        for s in row_blocks(inds0.size, blocksize):
+            phi0 += phases[inds0[s]].sum(axis=0)
+        phi0 /= inds0.size
+        z0 = cho_solve((self.chzfA1TzfA1, False),
+                       np.dot(self.zfA1f.T, self.bin_phase(phi0)))
+        for s in row_blocks(ns, blocksize):
+            phases[s] -= phi0.reshape(1, -1)
         LOG.info(f'calibrate(): Computing phases {time() - t1:.1f}')
 
         if status_cb:
             status_cb('Computing least-squares matrices ...')
         t1 = time()
-        nphi = phases.shape[1]
-        uiuiT = np.zeros((nu, nu))
-        phiiuiT = np.zeros((nphi, nu))
-        for i in inds1:
-            uiuiT += np.dot(U[:, [i]], U[:, [i]].T)
-            phiiuiT += np.dot(phases[[i], :].T, U[:, [i]].T)
+        # inputs of the frames used in the least-squares
+        Uls = np.zeros_like(U)
+        Uls[:, inds1] = U[:, inds1]
+        if normal is not None:
+            # apply the piston and reference phase corrections
+            pistons = row_means(phases, blocksize) + phi0.mean() - means
+            uiuiT = normal.uiuiT.copy()
+            phiiuiT = normal.phiiuiT + np.dot(Uls, pistons)
+            phiiuiT -= np.outer(phi0, Uls.sum(axis=1))
+        elif design is not None:
+            uiuiT = np.dot(Uls, Uls.T)
+            phiiuiT = design.demultiplex(phases).T
+        else:
+            uiuiT = np.dot(Uls, Uls.T)
+            phiiuiT = np.zeros((nphi, nu))
+            for s in row_blocks(ns, blocksize):
+                phiiuiT += np.dot(phases[s].T, Uls[:, s].T)
+        if self.zfB is not None:
+            # the rest of the calibration works on the binned pupil
+            phiiuiT = self.bin_phase(phiiuiT)
+            phasesb = np.empty((ns, self.zfB.shape[0]))
+            for s in row_blocks(ns, blocksize):
+                phasesb[s] = self.bin_phase(phases[s].T).T
+            phases = phasesb
+            report = self.binning_report(phi0.reshape(-1, 1), [pupil_bin])[0]
+            LOG.info(f'calibrate(): Binned {nphi} to {report["npixels"]} ' +
+                     f'pixels, z0 difference {report["z_max"]:.2e} rad')
+        zfA1 = self.zfA1f
         LOG.info(
             f'calibrate(): Computing least-squares matrices {time() - t1:.1f}')
         if status_cb:
@@ -223,21 +1034,47 @@ class RegLSCalib:
         t1 = time()
         A = np.dot(zfA1.T, zfA1)
         C = np.dot(zfA1.T, phiiuiT)
-        B = uiuiT
         U1 = cholesky(A, lower=False, overwrite_a=True)
         Y = solve_triangular(U1, C, trans='T', lower=False)
         D = solve_triangular(U1, Y, trans='N', lower=False)
-        U2 = cholesky(B, lower=False, overwrite_a=True)
-        YT = solve_triangular(U2, D.T, trans='T', lower=False)
-        XT = solve_triangular(U2, YT, trans='N', lower=False)
-        H = XT.T
+        if np.count_nonzero(uiuiT - np.diag(np.diag(uiuiT))) == 0:
+            # orthogonal design, e.g., make_hadamard_input_matrix()
+            def solve_uiuiT(X):
+                return X / np.diag(uiuiT).reshape(-1, 1)
+        else:
+            U2 = cholesky(uiuiT, lower=False)
+
+            def solve_uiuiT(X):
+                Y = solve_triangular(U2, X, trans='T', lower=False)
+                return solve_triangular(U2, Y, trans='N', lower=False)
 
-        def vaf(y, ye):
-            return 100 * (1 - np.var(y - ye, axis=1) / np.var(y, axis=1))
+        H = solve_uiuiT(D.T).T
 
-        mvaf = vaf(phases.T, zfA1 @ H @ U)
+        mvaf = chunked_vaf(phases, zfA1, H @ U)
         LOG.info(f'calibrate(): Solving least-squares {time() - t1:.1f}')
 
+        if cv_folds > 1:
+            if status_cb:
+                status_cb('Cross-validating ...')
+            t1 = time()
+            cvvaf = cross_validated_vaf(U, phases, zfA1, inds1, phiiuiT,
+                                        uiuiT, cv_folds)
+            LOG.info(f'calibrate(): Cross-validating {time() - t1:.1f}')
+        else:
+            cvvaf = None
+
+        if sparse_support > 0.:
+            if status_cb:
+                status_cb('Computing sparse influence functions ...')
+            t1 = time()
+            sparse = SparseInfluence.fit(
+                lambda s: solve_uiuiT(phiiuiT[s].T),
+                self.bin_phase(np.column_stack((xx[zfm], yy[zfm]))),
+                None if dmplot is None else dmplot.locations, sparse_support)
+            LOG.info(f'calibrate(): Sparse influence {time() - t1:.1f}')
+        else:
+            sparse = None
+
         if status_cb:
             status_cb('Applying regularisation ...')
         t1 = time()
@@ -248,32 +1085,47 @@ class RegLSCalib:
                                              (alpha) - 2 / alpha + 1))))
             win[rr < 1 - alpha / 2] = 1
             win[rr >= 1] = 0
+            win = self.bin_phase(win[zfm])
 
             stds = np.zeros(nu)
-            for i in range(nu):
-                ind = np.where(U[i, :] == U.max())[0][0]
-                stds[i] = np.std(phases[ind] * win[zfm])
+            if is_single_poke(U):
+                for i in range(nu):
+                    ind = np.where(U[i, :] == U.max())[0][0]
+                    stds[i] = np.std(phases[ind] * win)
+            else:
+                # frames poke many actuators, so use the least-squares
+                # estimate of the phase of each actuator poked at U.max()
+                F = solve_uiuiT(phiiuiT.T)
+                for i in range(nu):
+                    stds[i] = np.std(U.max() * F[i] * win)
+                del F
             stds -= stds.min()
             stds /= stds.max()
             assert (stds.min() == 0.)
             assert (stds.max() == 1.)
 
-            C = np.dot(pinv(lambda1 * np.diag(1 - stds) + np.dot(H.T, H)), H.T)
+            C = SPDSolver(lambda1 * np.diag(1 - stds) + np.dot(H.T, H),
+                          'calibrate()').solve(H.T)
         else:
-            C = np.linalg.pinv(H)
+            stds = None
+            C = pseudo_inverse(H, 'calibrate()')
         uflat = -np.dot(C, z0)
 
         self.fringe = fringe
         self.shape = shape
 
         self.H = H
+        self.factorisations = {}
         self.mvaf = mvaf
+        self.cvvaf = cvvaf
         self.phi0 = phi0
         self.z0 = z0
         self.uflat = uflat
         self.C = C
         self.alpha = alpha
         self.lambda1 = lambda1
+        self.stds = stds
+        self.sparse = sparse
 
         self.wavelength = wavelength
         self.dm_serial = dm_serial
@@ -286,9 +1138,82 @@ class RegLSCalib:
 
         LOG.info(f'calibrate(): Applying regularisation {time() - t1:.1f}')
 
+        if ckpt is not None and not keep_checkpoint:
+            ckpt.remove()
+        if scratch is not None:
+            del phases, phases1
+            scratch_file.close()
+
     def nactuators(self):
         return self.H.shape[1]
 
+    def _factorise_lambda1(self):
+        # simultaneously diagonalise H.T @ H and diag(1 - stds), i.e.,
+        # V.T @ (H.T @ H) @ V = diag(theta), V.T @ diag(1 - stds) @ V =
+        # I - diag(theta), so that the inverse for any lambda1 is diagonal
+        if self.stds is None:
+            raise ValueError('No regularisation weights; alpha = 0 ' +
+                             'or calibration saved by an older version')
+        if 'lambda1' not in self.factorisations:
+            HTH = np.dot(self.H.T, self.H)
+            try:
+                theta, V = eigh(HTH, HTH + np.diag(1 - self.stds))
+                self.factorisations['lambda1'] = (theta, V,
+                                                  np.dot(V.T, self.H.T))
+            except LinAlgError:
+                LOG.warning('_factorise_lambda1(): singular')
+                self.factorisations['lambda1'] = None
+        return self.factorisations['lambda1']
+
+    def regularised_inverse(self, lambda1):
+        "Control matrix `C` for the regularisation parameter `lambda1`"
+        fact = self._factorise_lambda1()
+        if fact is None:
+            return SPDSolver(
+                lambda1 * np.diag(1 - self.stds) + np.dot(self.H.T, self.H),
+                'regularised_inverse()').solve(self.H.T)
+        else:
+            theta, V, VTHT = fact
+            d = 1 / (lambda1 * (1 - theta) + theta)
+            return np.dot(V * d, VTHT)
+
+    def regularisation_path(self, lambda1s):
+        """Evaluate the regularisation for a sequence of `lambda1` values.
+
+        `H` is factorised once, so each value only costs a few matrix
+        products. Returns a dictionary of arrays with the condition number
+        of `C`, the maximum magnitude of `uflat`, the number of saturated
+        actuators in `uflat` and the norm of the Zernike coefficients of the
+        residual predicted after flattening [rad]. This is not divided by
+        the number of coefficients; since the Zernike polynomials are
+        orthonormal over the pupil, it is the rms of the residual phase.
+
+        """
+        lambda1s = np.array(lambda1s, dtype=float).ravel()
+        path = {
+            'lambda1': lambda1s,
+            'cond': np.zeros(lambda1s.size),
+            'uflat_max': np.zeros(lambda1s.size),
+            'saturation': np.zeros(lambda1s.size, dtype=int),
+            'residual': np.zeros(lambda1s.size),
+        }
+        for i, lambda1 in enumerate(lambda1s):
+            C = self.regularised_inverse(lambda1)
+            uflat = -np.dot(C, self.z0)
+            path['cond'][i] = np.linalg.cond(C)
+            path['uflat_max'][i] = np.abs(uflat).max()
+            path['saturation'][i] = (np.abs(uflat) > 1).sum()
+            path['residual'][i] = np.linalg.norm(self.z0 +
+                                                 np.dot(self.H, uflat))
+        return path
+
+    def set_lambda1(self, lambda1):
+        "Recompute `C` and `uflat` for a new `lambda1`"
+        self.C = self.regularised_inverse(lambda1)
+        self.uflat = -np.dot(self.C, self.z0)
+        self.lambda1 = lambda1
+        self.factorisations.pop('pinvC', None)
+
     def reflatten(self, exclude_zernike_noll=4):
         tmp = self.z0.copy()
         tmp[:exclude_zernike_noll] = 0
@@ -297,6 +1222,51 @@ class RegLSCalib:
     def get_rzern(self):
         return self.cart
 
+    def get_zfA1(self):
+        "Zernike polynomials sampled at the aperture pixels"
+        if self.zfA1 is None:
+            self._make_zfAs()
+        return self.zfA1
+
+    def bin_phase(self, phi):
+        "Bin the phase `phi` in the aperture, as in `phi[zfm]`, if enabled"
+        if self.zfB is None:
+            return phi
+        else:
+            return np.asarray(self.zfB @ phi)
+
+    def binning_report(self, phis, factors=(2, 4, 8)):
+        """Effect of binning the pupil on the Zernike coefficients.
+
+        `phis` is an `nphi x n` array of phases in the aperture, as in
+        `phi[zfm]`. For each binning factor, the Zernike coefficients fitted
+        on the binned pupil are compared with those of the full pupil.
+        Returns a list of dictionaries with the number of pixels, the time
+        per fit, and the maximum and rms differences of the coefficients in
+        rad. Factors that leave fewer pixels than polynomials are skipped.
+
+        """
+        zfA1 = self.get_zfA1()
+        z1 = np.linalg.lstsq(zfA1, phis, rcond=None)[0]
+        report = []
+        for factor in factors:
+            B = make_binning_matrix(self.zfm, factor)
+            if B.shape[0] < zfA1.shape[1]:
+                continue
+            zfA1b = np.asarray(B @ zfA1)
+            ch = cholesky(np.dot(zfA1b.T, zfA1b), lower=False)
+            t1 = time()
+            z2 = cho_solve((ch, False), np.dot(zfA1b.T, B @ phis))
+            t2 = time() - t1
+            report.append({
+                'factor': factor,
+                'npixels': B.shape[0],
+                'fit_time': t2 / phis.shape[1],
+                'z_max': np.abs(z2 - z1).max(),
+                'z_rms': np.sqrt(np.square(z2 - z1).mean()),
+            })
+        return report
+
     def zernike_eval(self, z):
         if self.zfA2 is None:
             self._make_zfAs()
@@ -311,7 +1281,8 @@ class RegLSCalib:
 
         t1 = time()
         Y = solve_triangular(self.chzfA1TzfA1,
-                             np.dot(self.zfA1.T, phi[self.zfm]),
+                             np.dot(self.zfA1f.T,
+                                    self.bin_phase(phi[self.zfm])),
                              trans='T',
                              lower=False)
         t2 = time()
@@ -356,17 +1327,31 @@ class RegLSCalib:
         z.fringe = FringeAnalysis.load_h5py(f, prefix + 'fringe/')
         z.zfA1 = None
         z.zfA2 = None
+        if prefix + 'pupil_bin' in f:
+            z.pupil_bin = int(f[prefix + 'pupil_bin'][()])
         z.zfm = f[prefix + 'zfm'][()]
         z.shape = f[prefix + 'shape'][()]
 
         z.H = f[prefix + 'H'][()]
         z.mvaf = f[prefix + 'mvaf'][()]
+        if prefix + 'cvvaf' in f:
+            z.cvvaf = f[prefix + 'cvvaf'][()]
+        else:
+            z.cvvaf = None
         z.phi0 = f[prefix + 'phi0'][()]
         z.z0 = f[prefix + 'z0'][()]
         z.uflat = f[prefix + 'uflat'][()]
         z.C = f[prefix + 'C'][()]
         z.alpha = f[prefix + 'alpha'][()][0]
         z.lambda1 = f[prefix + 'lambda1'][()][0]
+        if prefix + 'stds' in f:
+            z.stds = f[prefix + 'stds'][()]
+        else:
+            z.stds = None
+        if prefix + 'sparse/SparseInfluence' in f:
+            z.sparse = SparseInfluence.load_h5py(f, prefix + 'sparse/')
+        else:
+            z.sparse = None
 
         z.wavelength = f[prefix + 'wavelength'][()]
         z.dm_serial = h5_read_str(f, prefix + 'dm_serial')
@@ -378,7 +1363,7 @@ class RegLSCalib:
 
         if not lazy_cart_grid:
             xx, yy, _ = z.fringe.get_unit_aperture()
-            z.cart.make_cart_grid(xx, yy)
+            set_cart_grid(z.cart, xx, yy)
 
         z.zfA1TzfA1 = None
         z.chzfA1TzfA1 = None
@@ -416,6 +1401,9 @@ class RegLSCalib:
         f.create_dataset(prefix + 'H', **params)
         params['data'] = self.mvaf
         f.create_dataset(prefix + 'mvaf', **params)
+        if self.cvvaf is not None:
+            params['data'] = self.cvvaf
+            f.create_dataset(prefix + 'cvvaf', **params)
         params['data'] = self.phi0
         f.create_dataset(prefix + 'phi0', **params)
         params['data'] = self.z0
@@ -426,6 +1414,13 @@ class RegLSCalib:
         f.create_dataset(prefix + 'C', **params)
         f.create_dataset(prefix + 'alpha', data=np.array([self.alpha]))
         f.create_dataset(prefix + 'lambda1', data=np.array([self.lambda1]))
+        if self.stds is not None:
+            params['data'] = self.stds
+            f.create_dataset(prefix + 'stds', **params)
+        if self.sparse is not None:
+            self.sparse.save_h5py(f, prefix + 'sparse/', params=params)
+        if self.pupil_bin > 1:
+            f[prefix + 'pupil_bin'] = self.pupil_bin
 
         f[prefix + 'wavelength'] = self.wavelength
         h5_store_str(f, prefix + 'dm_serial', self.dm_serial)
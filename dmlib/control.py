@@ -4,12 +4,16 @@
 import json
 import logging
 from copy import deepcopy
+from time import perf_counter
 
 import numpy as np
-from numpy.linalg import norm, pinv, svd
+from numpy.linalg import norm, svd
 from numpy.random import normal
 
+from dmlib.calibration import make_binning_matrix
 from dmlib.core import h5_store_str
+from dmlib.linalg import (SPDSolver, cached, get_factorisations,
+                          pseudo_inverse)
 
 h5_prefix = 'dmlib/control/'
 
@@ -65,12 +69,13 @@ class ZernikeControl:
         self.pars = pars
         self.P = None
         self.R = None
+        self.R_key = None
         self.gui_callback = None
 
-        nz = calib.H.shape[0]
         nz = calib.H.shape[0]
         nu = calib.H.shape[1]
-        self.Cp = pinv(calib.C)
+        self.Cp = cached(calib, 'pinvC',
+                         lambda: pseudo_inverse(calib.C, 'ZernikeControl'))
 
         try:
             enabled = self.pars['enabled']
@@ -280,8 +285,11 @@ class ZernikeControl:
         tot = np.dot(Fy, np.dot(Fx, R))
         if tot.size == 1:
             self.R = None
+            self.R_key = None
         else:
             self.R = tot
+            # identifies R in the caches of calib, see svd_factorise()
+            self.R_key = (int(flipx), int(flipy), float(alpha))
         self.save_R()
         self.make_P()
 
@@ -353,66 +361,40 @@ class SVDControl(ZernikeControl):
             svd_modes = self.svd_pars['modes']
         else:
             svd_modes = 0
-        ignore = np.array(self.svd_pars['zernike_exclude'], dtype=np.int)
+        ignore = np.array(self.svd_pars['zernike_exclude'], dtype=int)
         nignore = ignore.size
 
-        self.h5_save('svd_modes', svd_modes)
         self.h5_save('ignore', ignore)
 
         self.make_P()
-        if self.P:
-            H = np.dot(self.P.T, self.calib.H)
-        else:
-            H = self.calib.H
-        smap = np.zeros(H.shape[0], dtype=np.bool)
-        smap[ignore - 1] = 1
-        O1 = np.eye(H.shape[0])
-        O1 = np.hstack((O1[:, smap], O1[:, np.invert(smap)])).T
-        test = np.zeros(H.shape[0])
-        test[smap] = 1
-        assert (np.dot(O1, test)[:ignore.size].sum() == ignore.size)
-        self.h5_save('O1', O1)
-        H = np.dot(O1, H)
-        self.h5_save('Htot', H)
-
-        Hl = H[:nignore, :]
-        # Hh = H[nignore:, :]
-        _, _, Vt = svd(Hl)
-        Vl2 = Vt[nignore:, :].T
-        test1 = np.dot(H, Vl2)
-        assert (test1.shape[0] == H.shape[0])
-        assert (test1.shape[1] == H.shape[1] - nignore)
-        assert (np.allclose(test1[:nignore, :], 0))
-
-        U, s, Vt = svd(np.dot(H, Vl2))
-        U1 = U[:, :s.size]
-        np.allclose(U1[:nignore, :], 0)
-
-        V1 = Vt[:svd_modes, :].T
-        s1i = np.power(s[:svd_modes], -1)
+        fact = svd_factorise(self.calib, ignore, self.P, self.R_key)
+        self.h5_save('O1', fact['O1'])
+        self.h5_save('Htot', fact['Htot'])
+
+        # only slices the cached factorisation
+        svd_modes = min(svd_modes, fact['s'].size)
+
+        V1 = fact['Vt'][:svd_modes, :].T
+        s1i = np.power(fact['s'][:svd_modes], -1)
         S1i = np.diag(s1i)
 
-        self.h5_make_empty('x', (svd_modes, ))
-        self.K = Vl2 @ V1 @ S1i
+        self.K = fact['Vl2'] @ (V1 * s1i.reshape(1, -1))
         self.ndof = svd_modes
         self.ab = np.zeros(svd_modes)
-        self.h5_save('ab', self.ab)
+        self.svd_pars['modes'] = svd_modes
 
-        def f(n, w):
-            a = h5_prefix + self.__class__.__name__ + '/svd/' + n
-            if isinstance(w, str):
-                h5_store_str(self.h5f, a, w)
-            else:
-                self.h5f[a] = w
+        self.h5_make_empty('x', (svd_modes, ))
+        self.h5_save('ab', self.ab)
+        self.h5_save('svd_modes', svd_modes)
+        self.h5_save('svd/svd_modes', svd_modes)
+        self.h5_save('svd/V1', V1)
+        self.h5_save('svd/S1i', S1i)
+        self.h5_save('svd/K', self.K)
 
         if self.h5f:
-            f('nignore', nignore)
-            f('svd_modes', svd_modes)
-            f('Vl2', Vl2)
-            f('V1', V1)
-            f('S1i', S1i)
-            f('K', self.K)
-            f('params', json.dumps(svd_pars))
+            self.h5_save('svd/nignore', nignore)
+            self.h5_save('svd/Vl2', fact['Vl2'])
+            self.h5_save('svd/params', json.dumps(svd_pars))
 
     def write(self, x):
         assert (x.shape == self.ab.shape)
@@ -454,6 +436,351 @@ class SVDControl(ZernikeControl):
         raise NotImplementedError()
 
 
+class IntegratorControl(ZernikeControl):
+    """Closed-loop leaky integrator acting on measured Zernike errors.
+
+    The integrator state `x` lives in the Zernike space of the calibration
+    and is mapped to the actuators with the control matrix `calib.C`. Each
+    call to `update()` takes the Zernike coefficients `z_ms` fitted to the
+    current wavefront measurement and computes
+
+        x = leak*x + g*(P*z_sp - z_ms)
+        u = C*x + uflat
+
+    where `g` is a vector of per-mode gains, `z_sp` is the setpoint set with
+    `set_setpoint()` and `P` is the pupil transform. Modes that are not
+    selected by the Zernike indices of `ZernikeControl` have zero gain. All
+    the intermediate quantities use preallocated buffers.
+
+    """
+    @staticmethod
+    def get_default_parameters():
+        return {
+            **ZernikeControl.get_default_parameters(),
+            'gain': 0.3,
+            'gains': [],
+            'leak': 0.99,
+            'nhist': 256,
+        }
+
+    @staticmethod
+    def get_parameters_info():
+        return {
+            **ZernikeControl.get_parameters_info(),
+            'gain': (float, (0., None), 'Integrator gain', 1),
+            'gains':
+            (list, float, 'Per-mode gains by Noll index (override gain)', 1),
+            'leak': (float, (0., 1.), 'Integrator leak factor', 1),
+            'nhist': (int, (1, None), 'Samples kept for loop statistics', 0),
+        }
+
+    def __init__(self, dm, calib, pars={}, h5f=None):
+        pars = {**deepcopy(self.get_default_parameters()), **deepcopy(pars)}
+        super().__init__(dm, calib, pars, h5f)
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        nz = self.nz
+        gains = np.full(nz, float(pars['gain']))
+        pgains = np.array(pars['gains'], dtype=float).ravel()[:nz]
+        gains[:pgains.size] = pgains
+        mask = np.ones(nz, dtype=bool)
+        mask[self.indices - 1] = 0
+        gains[mask] = 0.
+        # piston is not observable
+        gains[0] = 0.
+
+        self.gains = gains
+        self.leak = float(pars['leak'])
+        self.K = np.ascontiguousarray(calib.C)
+
+        self.x = np.zeros(nz)
+        self.e = np.zeros(nz)
+        self.sp = np.zeros(nz)
+        self.sp1 = np.zeros(nz)
+        self.ms = np.zeros(nz)
+
+        nhist = int(pars['nhist'])
+        self.periods = np.full(nhist, np.nan)
+        self.latencies = np.full(nhist, np.nan)
+        self.count = 0
+        self.last_ts = None
+
+        self.h5_save('gains', self.gains)
+        self.h5_save('leak', self.leak)
+        self.h5_make_empty('e', (nz, ))
+
+    def reset(self):
+        "Reset the integrator state and the loop statistics"
+        self.x[:] = 0.
+        self.periods[:] = np.nan
+        self.latencies[:] = np.nan
+        self.count = 0
+        self.last_ts = None
+
+    def set_setpoint(self, z):
+        "Set the Zernike setpoint for the controlled degrees of freedom"
+        assert (z.shape == self.ab.shape)
+        self.sp1[:] = 0.
+        self.sp1[self.indices - 1] = z[:]
+        self.sp1[self.indices - 1] += self.ab[:]
+        if self.P is not None:
+            np.dot(self.P, self.sp1, self.sp)
+        else:
+            self.sp[:] = self.sp1[:]
+
+    def update(self, z_ms=None, t_meas=None):
+        """Run one iteration of the loop.
+
+        Parameters
+        ----------
+        - `z_ms`: `numpy` Zernike coefficients fitted to the measurement, or
+          `None` to write the current integrator state only
+        - `t_meas`: `perf_counter()` time stamp of the measurement, used to
+          compute the latency
+
+        """
+        ts = perf_counter()
+
+        if z_ms is not None:
+            self.integrate(z_ms)
+
+        self.command()
+        if self.flat_on:
+            self.u += self.uflat
+
+        # handle saturation
+        if self.u.max() > 1. or self.u.min() < -1.:
+            self.log.debug('Saturation {}'.format(str(np.abs(self.u).max())))
+            np.clip(self.u, -1., 1., self.u)
+            self.saturation = 1
+        else:
+            self.saturation = 0
+
+        self.dm.write(self.u)
+
+        # loop statistics
+        te = perf_counter()
+        ind = self.count % self.periods.size
+        if self.last_ts is not None:
+            self.periods[ind] = ts - self.last_ts
+        if t_meas is None:
+            self.latencies[ind] = te - ts
+        else:
+            self.latencies[ind] = te - t_meas
+        self.last_ts = ts
+        self.count += 1
+
+        # logging
+        if self.h5f:
+            self.h5_append('e', self.e)
+            self.h5_append('u', self.u)
+
+        if self.gui_callback:
+            self.gui_callback()
+
+    def integrate(self, z_ms):
+        "Update the integrator state with a measurement"
+        self.ms[:] = z_ms[:self.nz]
+        np.subtract(self.sp, self.ms, self.e)
+        self.e *= self.gains
+        self.x *= self.leak
+        self.x += self.e
+
+    def command(self):
+        "Compute the input `u` without flattening from the integrator state"
+        np.dot(self.K, self.x, self.u)
+
+    def get_stats(self):
+        "Get the loop rate [Hz] and latency [s] over the recent iterations"
+        periods = self.periods[np.isfinite(self.periods)]
+        latencies = self.latencies[np.isfinite(self.latencies)]
+        if periods.size > 0:
+            rate = 1 / np.median(periods)
+        else:
+            rate = 0.
+        if latencies.size > 0:
+            lat_mean = latencies.mean()
+            lat_max = latencies.max()
+        else:
+            lat_mean = 0.
+            lat_max = 0.
+        return {
+            'count': self.count,
+            'rate': rate,
+            'latency': lat_mean,
+            'latency_max': lat_max,
+        }
+
+
+class ZonalControl(IntegratorControl):
+    """Closed-loop integrator acting directly on the measured phase.
+
+    Instead of fitting Zernike polynomials, the phase measured in the
+    aperture, optionally binned in `bin x bin` blocks (see
+    `make_binning_matrix()`, by default the `pupil_bin` of the calibration),
+    is mapped to the actuators with the regularised pseudo-inverse `K` of
+    the phase-space interaction matrix `D`. This is `zfA1 @ H` or, if
+    available with the same binning, the `SparseInfluence` model of the
+    calibration. Each call to `update()` takes the phase `phi` in the
+    aperture, as in `phi[calib.zfm]`, and computes
+
+        x = leak*x + gain*(K*B*D_sp*z_sp - K*B*phi)
+        u = x + uflat
+
+    where `B` is the binning and `D_sp` maps the Zernike setpoint to the
+    phase. The piston of the phase is ignored. The integrator state `x`
+    lives in the actuator space, so that each iteration is a single GEMV
+    with `K`.
+
+    """
+    @staticmethod
+    def get_default_parameters():
+        return {
+            **IntegratorControl.get_default_parameters(),
+            'bin': 0,
+            'lambda1': 1e-3,
+            'sparse': 1,
+        }
+
+    @staticmethod
+    def get_parameters_info():
+        return {
+            **IntegratorControl.get_parameters_info(),
+            'bin': (int, (0, None),
+                    'Pupil binning factor (0 for that of the calibration)', 1),
+            'lambda1': (float, (0., None), 'Relative regularisation', 1),
+            'sparse': (int, (0, 1), 'Use the sparse influence functions', 0),
+        }
+
+    def __init__(self, dm, calib, pars={}, h5f=None):
+        pars = {**deepcopy(self.get_default_parameters()), **deepcopy(pars)}
+        super().__init__(dm, calib, pars, h5f)
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        factor = int(pars['bin'])
+        if factor < 1:
+            factor = calib.pupil_bin
+        lambda1 = float(pars['lambda1'])
+        # the sparse model is sampled on the pupil of the calibration
+        sparse = (bool(pars['sparse']) and calib.sparse is not None
+                  and factor == calib.pupil_bin)
+        if factor > 1:
+            self.B = make_binning_matrix(calib.zfm, factor)
+        else:
+            self.B = None
+
+        def make_K():
+            if sparse:
+                D = calib.sparse.S
+            else:
+                D = np.dot(calib.get_zfA1(), calib.H)
+                if self.B is not None:
+                    D = self.B @ D
+            if not isinstance(D, np.ndarray):
+                D = D.toarray()
+            D = D - D.mean(axis=0).reshape(1, -1)
+            M = np.dot(D.T, D)
+            M += lambda1 * np.diag(M).mean() * np.eye(M.shape[0])
+            return np.ascontiguousarray(
+                SPDSolver(M, 'ZonalControl').solve(D.T))
+
+        self.K = cached(calib, ('ZonalControl', factor, lambda1, sparse),
+                        make_K)
+
+        # maps the Zernike setpoint to the actuators
+        zfA1 = calib.get_zfA1()
+        if self.B is not None:
+            zfA1 = self.B @ zfA1
+        self.Kz = np.dot(self.K, zfA1)
+
+        nu = self.nu
+        self.gain = float(pars['gain'])
+        self.x = np.zeros(nu)
+        self.e = np.zeros(nu)
+        self.sp_u = np.zeros(nu)
+
+        self.log.info(f'K {self.K.shape} bin {factor} sparse {sparse}')
+        self.h5_save('K', self.K)
+        self.h5_make_empty('e', (nu, ))
+
+    def set_setpoint(self, z):
+        super().set_setpoint(z)
+        np.dot(self.Kz, self.sp, self.sp_u)
+
+    def integrate(self, phi):
+        "Update the integrator state with the phase `phi` in the aperture"
+        if self.B is not None:
+            phi = self.B @ phi
+        np.dot(self.K, phi, self.e)
+        np.subtract(self.sp_u, self.e, self.e)
+        self.e *= self.gain
+        self.x *= self.leak
+        self.x += self.e
+
+    def command(self):
+        self.u[:] = self.x
+
+
+def svd_factorise(calib, ignore, P=None, P_key=None):
+    """Factorise the calibration matrix for `SVDControl`.
+
+    The factorisation depends only on the calibration, on the excluded Zernike
+    indices `ignore` and on the pupil transform `P`. The result is cached in
+    `calib`, so that a new `SVDControl` with a different number of SVD modes
+    only slices the cached `U`, `s`, and `Vt`. `P_key` identifies `P` in the
+    cache, e.g., `ZernikeControl.R_key`; if it is not given, `P` is hashed.
+
+    """
+    ignore = np.array(ignore, dtype=int).ravel()
+    if P is None:
+        P_key = None
+    elif P_key is None:
+        P_key = P.tobytes()
+    key = ('SVDControl', tuple(ignore.tolist()), P_key)
+    cache = get_factorisations(calib)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    nignore = ignore.size
+    if P is not None:
+        H = np.dot(P.T, calib.H)
+    else:
+        H = calib.H
+    smap = np.zeros(H.shape[0], dtype=bool)
+    smap[ignore - 1] = 1
+    O1 = np.eye(H.shape[0])
+    O1 = np.hstack((O1[:, smap], O1[:, np.invert(smap)])).T
+    test = np.zeros(H.shape[0])
+    test[smap] = 1
+    assert (np.dot(O1, test)[:ignore.size].sum() == ignore.size)
+    H = np.dot(O1, H)
+
+    Hl = H[:nignore, :]
+    # Hh = H[nignore:, :]
+    _, _, Vt = svd(Hl)
+    Vl2 = Vt[nignore:, :].T
+    test1 = np.dot(H, Vl2)
+    assert (test1.shape[0] == H.shape[0])
+    assert (test1.shape[1] == H.shape[1] - nignore)
+    assert (np.allclose(test1[:nignore, :], 0))
+
+    U, s, Vt = svd(test1, full_matrices=False)
+
+    fact = {
+        'O1': O1,
+        'Htot': H,
+        'Vl2': Vl2,
+        'U': U,
+        's': s,
+        'Vt': Vt,
+    }
+    cache[key] = fact
+
+    return fact
+
+
 def get_noll_indices(pars):
     noll_min = np.array(pars['min'], dtype=np.int)
     noll_max = np.array(pars['max'], dtype=np.int)
@@ -12,6 +12,7 @@ from os import path
 
 import h5py
 import numpy as np
+from h5py import h5z
 from numpy.linalg import norm
 from PyQt5.QtWidgets import QErrorMessage, QInputDialog
 
@@ -19,6 +20,12 @@ import dmlib.test
 from dmlib.dmplot import dmplot_from_layout, get_layouts
 from dmlib.version import __commit__, __date__, __version__
 
+try:
+    # registers the HDF5 filters of compressed datasets, e.g., lz4 images
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 LOG = logging.getLogger('core')
 
 
@@ -35,6 +42,23 @@ def h5_read_str(f, a):
     return tmp
 
 
+def check_h5_filters(dset):
+    """Check that the HDF5 filters needed to read `dset` are available.
+
+    Raises a `ValueError` naming the missing filter, rather than the error
+    of `h5py` when reading the data, e.g., if `hdf5plugin` is not installed
+    to read lz4 compressed images.
+
+    """
+    plist = dset.id.get_create_plist()
+    for i in range(plist.get_nfilters()):
+        code = plist.get_filter(i)[0]
+        if not h5z.filter_avail(code):
+            raise ValueError(
+                f'{dset.name} is compressed with the HDF5 filter {code}, ' +
+                'which is not available; install hdf5plugin')
+
+
 # https://stackoverflow.com/questions/22058048
 def hash_file(fname):
     BLOCKSIZE = 65536
@@ -91,16 +115,139 @@ class SquareRoot:
         return self.name
 
 
+class SimInterferometer:
+    """Render tilted-carrier interferograms of a simulated DM.
+
+    The ground-truth influence functions are Gaussians centred at the
+    actuator locations of a `DMPlot` layout. The layout is scaled so that the
+    outermost actuators lie on the rim of a circular pupil of `radius` pixels
+    centred on the camera. Since the Gaussians are separable, the phase for a
+    command `u` is computed with a single matrix product as `Gy*diag(u)*Gx.T`.
+    A dense influence matrix of size `(ny*nx, nu)` can be passed with
+    `influence` instead.
+
+    Parameters
+    ----------
+    - `dmplot`: `DMPlot` with the actuator locations
+    - `shape`: camera shape `(ny, nx)`
+    - `pxsize`: camera pixel size `(hP, wP)` in um
+    - `radius`: pupil radius in pixels, by default `0.35*min(shape)`
+    - `sigma`: width of the influence functions in actuator pitches
+    - `stroke`: phase in rad for a unit command
+    - `carrier`: tilt of the reference beam in cycles per um `(fx, fy)`
+    - `noise`: standard deviation of the additive noise (fraction of max)
+    - `influence`: optional dense influence matrix
+    - `phi0`: optional static aberration of size `shape` in rad
+
+    """
+    def __init__(self,
+                 dmplot,
+                 shape,
+                 pxsize,
+                 radius=None,
+                 sigma=1.,
+                 stroke=2 * np.pi,
+                 carrier=None,
+                 visibility=.8,
+                 noise=.01,
+                 influence=None,
+                 phi0=None,
+                 dtype='uint8',
+                 seed=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        ny, nx = int(shape[0]), int(shape[1])
+        hP, wP = pxsize
+        if radius is None:
+            radius = .35 * min(ny, nx)
+        if carrier is None:
+            # about 9 pixels per fringe at 45 degrees
+            carrier = (1 / (9 * np.sqrt(2) * wP), 1 / (9 * np.sqrt(2) * hP))
+
+        locs = np.array(dmplot.locations, dtype=float)
+        nu = locs.shape[0]
+        dists = np.sqrt(
+            np.square(locs.reshape(-1, 1, 2) - locs.reshape(1, -1, 2)).sum(
+                axis=2))
+        dists[np.arange(nu), np.arange(nu)] = np.inf
+        pitch = np.median(dists.min(axis=1))
+        scale = radius / np.sqrt(np.square(locs).sum(axis=1)).max()
+
+        yv = np.arange(ny, dtype=float) - ny / 2
+        xv = np.arange(nx, dtype=float) - nx / 2
+        w = sigma * pitch * scale
+        Gx = np.exp(-np.square(xv.reshape(-1, 1) - scale * locs[:, 0]) /
+                    (2 * w**2))
+        Gy = np.exp(-np.square(yv.reshape(-1, 1) - scale * locs[:, 1]) /
+                    (2 * w**2))
+
+        xx, yy = np.meshgrid(xv, yv)
+        rr = np.sqrt(xx**2 + yy**2) / radius
+        env = np.exp(-np.square(rr) / 2)
+        env[rr >= 1] = 0
+        carr = 2 * np.pi * (carrier[0] * xx * wP + carrier[1] * yy * hP)
+
+        self.shape = (ny, nx)
+        self.nu = nu
+        self.radius = radius
+        self.stroke = stroke
+        self.noise = noise
+        self.dtype = np.dtype(dtype)
+        self.maxval = np.iinfo(self.dtype).max
+        self.Gx = (stroke * Gx).astype(np.float32)
+        self.Gy = Gy.astype(np.float32)
+        if influence is not None:
+            influence = np.asarray(influence, dtype=np.float32)
+            if influence.shape != (ny * nx, nu):
+                raise ValueError('influence.shape != (ny*nx, nu)')
+        self.influence = influence
+        self.carr = carr.astype(np.float32)
+        if phi0 is not None:
+            self.carr += np.asarray(phi0, dtype=np.float32)
+        self.bias = (.45 * self.maxval * env).astype(np.float32)
+        self.amp = (visibility * self.bias).astype(np.float32)
+        self.rng = np.random.default_rng(seed)
+        self.phi = np.zeros(self.shape, dtype=np.float32)
+        self.buf = np.zeros(self.shape, dtype=np.float32)
+
+    def phase(self, u):
+        "Phase [rad] at the camera for command `u`"
+        u = np.asarray(u, dtype=np.float32).ravel()
+        assert (u.size == self.nu)
+        if self.influence is not None:
+            np.dot(self.influence, u, self.phi.reshape(-1))
+        else:
+            np.dot(self.Gy * u.reshape(1, -1), self.Gx.T, self.phi)
+        return self.phi
+
+    def render(self, u):
+        "Render an interferogram for command `u`"
+        buf = self.buf
+        np.add(self.phase(u), self.carr, buf)
+        np.cos(buf, buf)
+        buf *= self.amp
+        buf += self.bias
+        if self.noise > 0:
+            buf += self.rng.standard_normal(self.shape, dtype=np.float32) * (
+                self.noise * self.maxval)
+        np.clip(buf, 0, self.maxval, buf)
+        return buf.astype(self.dtype)
+
+
 class FakeCam():
-    def __init__(self, shape=(1024, 1280), pxsize=(7.4, 7.4)):
+    def __init__(self, shape=(1024, 1280), pxsize=(7.4, 7.4), pool_size=8):
         self.log = logging.getLogger(self.__class__.__name__)
         self.exp = 0.06675 + 5 * 0.06675
         self.fps = 4
         self.name = None
+        self.sim = None
+        self.dm = None
+        self.pool = None
+        self.pool_size = pool_size
         assert (len(shape) == 2)
         assert (len(pxsize) == 2)
-        self._shape = shape
-        self._pxsize = pxsize
+        self._shape = (int(shape[0]), int(shape[1]))
+        self._pxsize = (float(pxsize[0]), float(pxsize[1]))
 
     def open(self, name=''):
         self.name = name
@@ -109,9 +256,18 @@ class FakeCam():
     def close(self):
         self.log.info(f'close {self.name:}')
 
+    def set_simulator(self, sim, dm):
+        "Render images with `sim` from the commands written to `dm`"
+        self.sim = sim
+        self.dm = dm
+
     def grab_image(self):
-        img = dmlib.test.load_int3(self._shape)
-        img = img.astype(self.get_image_dtype())
+        if self.sim is not None:
+            return self.sim.render(self.dm.u)
+        if self.pool is None:
+            self.pool = dmlib.test.make_int3_pool(self._shape, self.pool_size)
+        img = dmlib.test.sample_int3_pool(self.pool)
+        img = img.astype(self.get_image_dtype(), copy=False)
         assert (img.dtype == self.get_image_dtype())
         assert (img.shape == self.shape())
         return img
@@ -165,6 +321,7 @@ class FakeDM():
         self.transform = None
         self._size = 140
         self.presets = {}
+        self.u = np.zeros(self._size)
 
     def open(self, name=''):
         self.name = name
@@ -180,6 +337,7 @@ class FakeDM():
         return self._size
 
     def write(self, v):
+        self.u[:] = v
         if self.transform:
             v = self.transform(v)
 
@@ -195,6 +353,7 @@ class FakeDM():
     def from_dmplot(self, dmplot):
         self._size = dmplot.size()
         self.presets = dmplot.presets
+        self.u = np.zeros(self._size)
 
     def preset(self, name, mag=0.7):
         return mag * self.presets[name]
@@ -514,3 +673,19 @@ def add_cam_parameters(parser):
                         type=float,
                         nargs=2,
                         default=(5.20, 5.20))
+    parser.add_argument(
+        '--sim-interf',
+        action='store_true',
+        help='Render simulated interferograms from the simulated DM')
+
+
+def make_sim_interf(args, cam, dm, dmplot):
+    "Attach a `SimInterferometer` to a simulated camera and DM"
+    if not getattr(args, 'sim_interf', False):
+        return None
+    if not isinstance(cam, FakeCam) or not isinstance(dm, FakeDM):
+        raise ValueError('--sim-interf requires the sim drivers')
+    sim = SimInterferometer(dmplot, cam.shape(), cam.get_pixel_size(),
+                            dtype=cam.get_image_dtype())
+    cam.set_simulator(sim, dm)
+    return sim
@@ -5,12 +5,17 @@ import argparse
 import logging
 import multiprocessing
 import os
+import pickle
 import platform
+import queue
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from multiprocessing import Array, Process, Queue, Value
+from multiprocessing import Array, Lock, Process, Queue, Value
 from os import path
 
 import h5py
@@ -30,12 +35,16 @@ from PyQt5.QtWidgets import (QApplication, QCheckBox, QDialog, QDoubleSpinBox,
                              QSplitter, QStyleFactory, QTabWidget, QToolBox,
                              QVBoxLayout)
 
-from dmlib.calibration import RegLSCalib, make_normalised_input_matrix
-from dmlib.control import ZernikeControl, get_noll_indices
+from dmlib.calibration import (HadamardDesign, NormalMatrices, RegLSCalib,
+                               extract_phase, make_normalised_input_matrix,
+                               make_phase_pool, make_random_input_matrix)
+from dmlib.control import (IntegratorControl, ZernikeControl, ZonalControl,
+                           get_noll_indices)
 from dmlib.core import (add_cam_parameters, add_dm_parameters,
-                        add_log_parameters, get_suitable_dmplot, h5_read_str,
-                        h5_store_str, hash_file, open_cam, open_dm,
-                        setup_logging, spawn_file, write_h5_header)
+                        add_log_parameters, check_h5_filters,
+                        get_suitable_dmplot, h5_read_str, h5_store_str,
+                        hash_file, hdf5plugin, make_sim_interf, open_cam,
+                        open_dm, setup_logging, spawn_file, write_h5_header)
 from dmlib.dmplot import DMPlot
 from dmlib.interf import FringeAnalysis
 from dmlib.version import __version__
@@ -599,6 +608,9 @@ class Control(QMainWindow):
 
         def f20():
             def f(result):
+                listener.busy = True
+                self.shared.acquire()
+
                 a1 = self.align_axes[0, 0]
                 a2 = self.align_axes[0, 1]
                 a3 = self.align_axes[0, 2]
@@ -614,8 +626,8 @@ class Control(QMainWindow):
                 a6.clear()
 
                 if result[0] != 'ERR1':
-                    a1.imshow(self.shared.cam,
-                              extent=self.shared.cam_ext,
+                    a1.imshow(self.shared.cam.copy(),
+                              extent=tuple(self.shared.cam_ext),
                               origin='lower')
                     a1.set_xlabel('mm')
                     if self.shared.cam_sat.value:
@@ -625,8 +637,8 @@ class Control(QMainWindow):
                                      f'{self.shared.cam.max(): 3d}')
 
                 if listener.unwrap and result[0] not in ('ERR1', 'ERR2'):
-                    a2.imshow(self.shared.ft,
-                              extent=self.shared.ft_ext,
+                    a2.imshow(self.shared.ft.copy(),
+                              extent=tuple(self.shared.ft_ext),
                               origin='lower')
                     a2.set_xlabel('1/mm')
                     a2.set_title('FT')
@@ -646,23 +658,25 @@ class Control(QMainWindow):
                     fstord, mag, wrapped, unwrapped = self.shared.get_phase()
 
                     a3.imshow(fstord,
-                              extent=self.shared.fstord_ext,
+                              extent=tuple(self.shared.fstord_ext),
                               origin='lower')
                     a3.set_xlabel('1/mm')
                     a3.set_title(f'1st order {fstord.shape}')
 
-                    a4.imshow(mag, extent=self.shared.mag_ext, origin='lower')
+                    a4.imshow(mag,
+                              extent=tuple(self.shared.mag_ext),
+                              origin='lower')
                     a4.set_xlabel('mm')
                     a4.set_title('magnitude')
 
                     a5.imshow(wrapped,
-                              extent=self.shared.mag_ext,
+                              extent=tuple(self.shared.mag_ext),
                               origin='lower')
                     a5.set_xlabel('mm')
                     a5.set_title('wrapped phi')
 
                     a6.imshow(unwrapped,
-                              extent=self.shared.mag_ext,
+                              extent=tuple(self.shared.mag_ext),
                               origin='lower')
                     a6.set_xlabel('mm')
                     a6.set_title('unwrapped phi')
@@ -681,6 +695,9 @@ class Control(QMainWindow):
                         status.setText(result[2])
                     enable()
 
+                self.shared.release()
+                listener.busy = False
+
             return f
 
         def fpoke():
@@ -768,12 +785,17 @@ class Control(QMainWindow):
         bcalibrate = QPushButton('calibrate')
         bcalibrate.setToolTip('Compute a calibration file')
         layout.addWidget(bcalibrate, 5, 1)
+        bphases = QCheckBox('phases')
+        bphases.setToolTip(
+            'Extract the phases while acquiring so that the calibration ' +
+            'is ready sooner; the pupil size is asked before running')
+        layout.addWidget(bphases, 5, 2)
         bclear = QPushButton('clear')
         layout.addWidget(bclear, 5, 4)
 
         disables = [
             self.toolbox, brun, bwavelength, bplot, self.dataacq_nav, bprev,
-            bnext, baperture, bcalibrate, bclear, bpoke, bsleep
+            bnext, baperture, bcalibrate, bclear, bpoke, bsleep, bphases
         ]
 
         wavelength = []
@@ -859,6 +881,24 @@ class Control(QMainWindow):
                 while not wavelength:
                     askwl()
 
+                if bphases.isChecked():
+                    if self.shared.cam_ext[1] > 0:
+                        radmax = min(
+                            (self.shared.cam_ext[1], self.shared.cam_ext[3]))
+                    else:
+                        radmax = 10.
+
+                    val, ok = QInputDialog.getDouble(
+                        self, 'Aperture radius',
+                        f'Radius [mm] (max {radmax:.3f} mm)<br>' +
+                        'As seen by the camera (including magnification)',
+                        listener.radius / 1000 or 2.1, 0., radmax, 6)
+                    if not ok:
+                        return
+                    listener.radius = val * 1000
+                else:
+                    listener.radius = 0.
+
                 self.dataacq_axes[0, 0].clear()
                 self.dataacq_axes[0, 1].clear()
                 self.dataacq_axes[1, 0].clear()
@@ -940,6 +980,7 @@ class Control(QMainWindow):
                 self.shared.iq.put(('plot', dataset[0], val, radius[0]))
                 if check_err() == -1:
                     return
+                self.shared.acquire()
 
                 a1 = self.dataacq_axes[0, 0]
                 a2 = self.dataacq_axes[0, 1]
@@ -950,8 +991,8 @@ class Control(QMainWindow):
                 a3.clear()
                 a4.clear()
 
-                a1.imshow(self.shared.cam,
-                          extent=self.shared.cam_ext,
+                a1.imshow(self.shared.cam.copy(),
+                          extent=tuple(self.shared.cam_ext),
                           origin='lower')
                 a1.set_xlabel('mm')
                 if self.shared.cam_sat.value:
@@ -970,12 +1011,14 @@ class Control(QMainWindow):
                 a2.set_ylim([-1, 1])
                 self.dmplot.update(self.shared.u)
 
-                a3.imshow(wrapped, extent=self.shared.mag_ext, origin='lower')
+                a3.imshow(wrapped,
+                          extent=tuple(self.shared.mag_ext),
+                          origin='lower')
                 a3.set_xlabel('mm')
                 a3.set_title('wrapped phi')
 
                 a4.imshow(unwrapped,
-                          extent=self.shared.mag_ext,
+                          extent=tuple(self.shared.mag_ext),
                           origin='lower')
                 a4.set_xlabel('mm')
                 a4.set_title('unwrapped phi')
@@ -988,6 +1031,7 @@ class Control(QMainWindow):
                         'r')
 
                 a4.figure.canvas.draw()
+                self.shared.release()
 
                 status.setText(
                     path.basename(dataset[0]) + f' {val}/{ndata[0] - 1}')
@@ -1089,11 +1133,12 @@ class Control(QMainWindow):
         def f20():
             def f(msg):
                 listener.busy = True
+                self.shared.acquire()
 
                 a1 = self.dataacq_axes[0, 0]
                 a1.clear()
-                a1.imshow(self.shared.cam,
-                          extent=self.shared.cam_ext,
+                a1.imshow(self.shared.cam.copy(),
+                          extent=tuple(self.shared.cam_ext),
                           origin='lower')
                 a1.set_xlabel('mm')
                 if self.shared.cam_sat.value:
@@ -1116,6 +1161,7 @@ class Control(QMainWindow):
                         dataset[0] = msg[1]
                     else:
                         dataset.append(msg[1])
+                    radius[0] = listener.radius
                     status.setText('Saved calibration data file ' + msg[1])
                     try:
                         spawn_file(path.abspath(msg[1]))
@@ -1130,6 +1176,7 @@ class Control(QMainWindow):
                     enable()
 
                 a1.figure.canvas.draw()
+                self.shared.release()
                 listener.busy = False
 
             return f
@@ -1224,10 +1271,28 @@ class Control(QMainWindow):
         layout.addWidget(bnoflat, 4, 2)
         bclear = QPushButton('clear')
         layout.addWidget(bclear, 4, 3)
+        bclosed = QCheckBox('closed loop')
+        bclosed.setChecked(False)
+        bclosed.setToolTip(
+            'Track the Zernike setpoint with an integrator using the ' +
+            'interferometer measurements')
+        layout.addWidget(bclosed, 4, 4)
+        bzonal = QCheckBox('zonal')
+        bzonal.setChecked(False)
+        bzonal.setToolTip(
+            'Close the loop on the measured phase instead of the fitted ' +
+            'Zernike coefficients')
+        layout.addWidget(bzonal, 3, 4)
+        bpipeline = QPushButton('pipeline')
+        bpipeline.setToolTip(
+            'Number of frames in flight; the analysis of a frame overlaps ' +
+            'with the DM settling and grabbing of the next ones')
+        layout.addWidget(bpipeline, 2, 4)
 
         disables = [
             self.toolbox, brun, bflat, bnoflat, bzernike, bclear,
-            self.test_nav, bzernike, bsleep, bzsize
+            self.test_nav, bzernike, bsleep, bzsize, bclosed, bpipeline,
+            bzonal
         ]
         llistener = LoopListener(self.shared, status, self.sleepmag)
         calib = []
@@ -1239,6 +1304,7 @@ class Control(QMainWindow):
         }
         arts = []
         noflat_index = [0]
+        pipeline = [1]
 
         def clearup(clear_status=False):
             for c in arts:
@@ -1355,6 +1421,9 @@ class Control(QMainWindow):
                 llistener.calib = calib[0]
                 llistener.flat = bflat.isChecked()
                 llistener.noflat_index = noflat_index[0]
+                llistener.closed_loop = bclosed.isChecked()
+                llistener.zonal = bzonal.isChecked()
+                llistener.pipeline = pipeline[0]
                 llistener.start()
 
             return f
@@ -1362,6 +1431,7 @@ class Control(QMainWindow):
         def make_cb():
             def f():
                 llistener.busy = True
+                self.shared.acquire()
 
                 noll_inds = get_noll_indices(noll_sel_pars) - 1
                 noll_inds.sort()
@@ -1384,7 +1454,7 @@ class Control(QMainWindow):
                 if len(arts) != 1:
                     ax3 = self.test_axes[1]
                     im = ax3.imshow(phi_ms,
-                                    extent=self.shared.mag_ext,
+                                    extent=tuple(self.shared.mag_ext),
                                     origin='lower')
                     ax3.axis('off')
                     cb = ax3.figure.colorbar(im, ax=ax3)
@@ -1402,6 +1472,7 @@ class Control(QMainWindow):
 
                 self.test_fig.figure.canvas.draw()
 
+                self.shared.release()
                 llistener.busy = False
 
             return f
@@ -1449,6 +1520,17 @@ class Control(QMainWindow):
 
             return f
 
+        def fpipeline():
+            def f():
+                val, ok = QInputDialog.getInt(
+                    self, 'Pipeline depth',
+                    'Frames in flight (1 runs the loop serially):',
+                    pipeline[0], 1, 8)
+                if ok:
+                    pipeline[0] = val
+
+            return f
+
         brun.clicked.connect(f1())
         bstop.clicked.connect(f4())
         bzernike.clicked.connect(f2())
@@ -1456,6 +1538,7 @@ class Control(QMainWindow):
         bsleep.clicked.connect(fs1())
         bzsize.clicked.connect(fbzernike())
         bnoflat.clicked.connect(f5())
+        bpipeline.clicked.connect(fpipeline())
 
 
 # https://stackoverflow.com/questions/41794635/
@@ -1473,22 +1556,35 @@ class AlignListener(QThread):
         self.poke = False
         self.sleepmag = sleepmag
         self.unwrap = True
+        self.busy = False
         self.shared = shared
         self.log = logging.getLogger('AlignListener')
 
     def run(self):
-        self.shared.iq.put(('align', self.auto, self.repeat, self.poke,
-                            self.sleepmag[0], self.unwrap))
+        shared = self.shared
+        last = shared.seq.value
+        shared.start_run()
+        shared.iq.put(('align', self.auto, self.repeat, self.poke,
+                       self.sleepmag[0], self.unwrap))
         while True:
-            result = self.shared.oq.get()
-            self.sig_update.emit(result)
-            if result[0] != 'OK' and result[1] == 'STOP':
-                self.repeat = False
-            self.shared.iq.put(('stopcmd', not self.repeat))
-            self.shared.oq.get()
             if not self.repeat:
+                shared.request_stop()
+            running = shared.is_running()
+            seq, result = shared.get_latest()
+            if not running:
+                # the last result is published before running is cleared
+                seq, result = shared.get_latest()
+                self.repeat = False
+                if result is not None and seq != last:
+                    self.sig_update.emit(result)
+                self.log.info('dies')
                 return
-        self.log.info('dies')
+            elif seq != last and not self.busy:
+                last = seq
+                if result[0] != 'OK' and result[1] == 'STOP':
+                    self.repeat = False
+                self.sig_update.emit(result)
+            self.msleep(POLL_MS)
 
 
 class CalibListener(QThread):
@@ -1527,25 +1623,30 @@ class DataAcqListener(QThread):
         self.log = logging.getLogger('DataAcqListener')
         self.pokemag = pokemag
         self.sleepmag = sleepmag
+        self.radius = 0.
 
     def run(self):
-        self.shared.iq.put(('dataacq', self.wavelength[0], self.dmplot.clone(),
-                            self.pokemag[0], self.sleepmag[0]))
+        shared = self.shared
+        last = shared.seq.value
+        shared.start_run()
+        shared.iq.put(('dataacq', self.wavelength[0], self.dmplot.clone(),
+                       self.pokemag[0], self.sleepmag[0], self.radius))
         while True:
-            result = self.shared.oq.get()
-            if result[0] == 'OK':
-                self.shared.iq.put(('stopcmd', not self.run))
-                self.shared.oq.get()
-                if not self.run:
-                    self.sig_update.emit(('stopped', ))
-                    self.log.info('dies')
-                    return
-                elif not self.busy:
+            if not self.run:
+                shared.request_stop()
+            running = shared.is_running()
+            seq, result = shared.get_latest()
+            if not running:
+                # the last result is published before running is cleared
+                seq, result = shared.get_latest()
+                if result is not None and seq != last:
                     self.sig_update.emit(result)
-            else:
-                self.sig_update.emit(result)
                 self.log.info('dies')
                 return
+            elif seq != last and not self.busy:
+                last = seq
+                self.sig_update.emit(result)
+            self.msleep(POLL_MS)
 
 
 class LoopListener(QThread):
@@ -1559,63 +1660,100 @@ class LoopListener(QThread):
         self.calib = False
         self.flat = True
         self.noflat_index = 0
-        self.closed_loop = True
+        self.closed_loop = False
+        self.zonal = False
+        self.pipeline = 1
         self.shared = shared
         self.log = logging.getLogger('LoopListener')
         self.status = status
         self.sleepmag = sleepmag
 
     def run(self):
-        self.shared.iq.put(('loop', self.calib, self.flat, self.noflat_index,
-                            self.closed_loop, self.sleepmag[0]))
+        shared = self.shared
+        last = shared.seq.value
+        shared.start_run()
+        shared.iq.put(('loop', self.calib, self.flat, self.noflat_index,
+                       self.closed_loop, self.sleepmag[0], self.pipeline,
+                       self.zonal))
+        shown = last
         while True:
-            result = self.shared.oq.get()
-            self.status.setText('')
-            if result[0] == 'OK':
-                self.shared.iq.put(('stopcmd', not self.run))
-                self.shared.oq.get()
-                if not self.run:
-                    self.sig_update.emit(('stopped', ))
-                    self.log.info('dies')
-                    return
-                elif not self.busy:
+            if not self.run:
+                shared.request_stop()
+            running = shared.is_running()
+            seq, result = shared.get_latest()
+            if not running:
+                # the last result is published before running is cleared
+                seq, result = shared.get_latest()
+                if result is not None and seq != shown:
                     self.sig_update.emit(result)
-                else:
-                    self.log.debug('throttling')
-            else:
-                self.sig_update.emit(result)
                 self.log.info('dies')
                 return
+            elif seq != last:
+                last = seq
+                self.status.setText('')
+                if not self.busy:
+                    shown = seq
+                    self.sig_update.emit(result)
+                else:
+                    self.log.debug('throttling')
+            self.msleep(POLL_MS)
+
+
+# size of a result slot in the control block of Shared
+RESULT_SIZE = 4096
+
+# polling interval of the listeners [ms]
+POLL_MS = 2
+
+# number of frame slots in the ring of Shared, at least three so that the
+# worker always finds a slot that is neither the latest nor being displayed
+NSLOTS = 3
+
+# calibrations whose phases exceed this size in bytes keep them on disk
+SCRATCH_SIZE = 2**31
+
+# frames between the Zernike fits displayed by the zonal loop
+ZONAL_FIT_EVERY = 10
 
 
 class Shared:
-    def __init__(self, cam, dm):
+    def __init__(self, cam, dm, nslots=NSLOTS):
         dbl_dtsize = np.dtype('float').itemsize
         cam_dtsize = np.dtype(cam.get_image_dtype()).itemsize
         cam_shape = cam.shape()
         cam_shape = (int(cam_shape[0]), int(cam_shape[1]))
         totpixs = cam_shape[0] * cam_shape[1]
 
-        self.cam_buf = Array('c', cam_dtsize * totpixs, lock=False)
+        assert (nslots >= 3)
+        self.nslots = nslots
+
         self.cam_ext = Array('d', 4, lock=False)
         self.cam_sat = Value('i', lock=False)
         self.dm_sat = Value('i', lock=False)
         self.z_size = Value('i', lock=False)
 
-        self.ft_buf = Array('d', totpixs, lock=False)
         self.ft_ext = Array('d', 4, lock=False)
 
         self.fxcfyc = Array('d', 2, lock=False)
 
-        self.fstord_buf = Array('c', dbl_dtsize * totpixs, lock=False)
-        self.fstord_ext = Array('d', 4, lock=False)
-        self.fstord_shape = Array('i', 2, lock=False)
-
-        self.mag_buf = Array('c', dbl_dtsize * totpixs, lock=False)
-        self.wrapped_buf = Array('c', dbl_dtsize * totpixs, lock=False)
-        self.unwrapped_buf = Array('c', dbl_dtsize * totpixs, lock=False)
-        self.mag_ext = Array('d', 4, lock=False)
-        self.mag_shape = Array('i', 2, lock=False)
+        # ring of frame slots, see begin_frame() and acquire()
+        self.cam_buf = Array('c', nslots * cam_dtsize * totpixs, lock=False)
+        self.ft_buf = Array('d', nslots * totpixs, lock=False)
+        self.fstord_buf = Array('c', nslots * dbl_dtsize * totpixs, lock=False)
+        self.mag_buf = Array('c', nslots * dbl_dtsize * totpixs, lock=False)
+        self.wrapped_buf = Array(
+            'c', nslots * dbl_dtsize * totpixs, lock=False)
+        self.unwrapped_buf = Array(
+            'c', nslots * dbl_dtsize * totpixs, lock=False)
+        self.slot_fstord_ext = Array('d', 4 * nslots, lock=False)
+        self.slot_fstord_shape = Array('i', 2 * nslots, lock=False)
+        self.slot_mag_ext = Array('d', 4 * nslots, lock=False)
+        self.slot_mag_shape = Array('i', 2 * nslots, lock=False)
+        self.slot_seq = Array('l', nslots, lock=False)
+        self.frame_seq = Value('l', lock=False)
+        self.latest = Value('i', -1, lock=False)
+        self.reading = Value('i', -1, lock=False)
+        self.slot_lock = Lock()
 
         self.totpixs = totpixs
         self.cam_dtype = cam.get_image_dtype()
@@ -1623,33 +1761,232 @@ class Shared:
 
         self.dm = Array('d', int(dm.size()), lock=False)
         self.z_sp_buf = Array('d', 1024, lock=False)
-        self.z_ms_buf = Array('d', 1024, lock=False)
-        self.z_er_buf = Array('d', 1024, lock=False)
+        self.z_ms_buf = Array('d', nslots * 1024, lock=False)
+        self.z_er_buf = Array('d', nslots * 1024, lock=False)
         self.iq = Queue()
         self.oq = Queue()
 
+        # control block for the free-running loops (align, dataacq, loop)
+        self.stop = Value('i', lock=False)
+        self.running = Value('i', lock=False)
+        self.seq = Value('l', lock=False)
+        self.result_buf = Array('c', 2 * RESULT_SIZE, lock=False)
+        self.result_len = Array('i', 2, lock=False)
+        self.result_seq = Array('l', 2, lock=False)
+
     def make_static(self):
+        n = self.nslots
         self.u = np.frombuffer(self.dm, float)
         self.z_sp = np.frombuffer(self.z_sp_buf, float)
-        self.z_ms = np.frombuffer(self.z_ms_buf, float)
-        self.z_er = np.frombuffer(self.z_er_buf, float)
-        self.cam = np.frombuffer(self.cam_buf,
-                                 self.cam_dtype).reshape(self.cam_shape)
-        self.ft = np.frombuffer(self.ft_buf, float).reshape(self.cam_shape)
+        self.slot_z_ms = np.frombuffer(self.z_ms_buf, float).reshape(n, -1)
+        self.slot_z_er = np.frombuffer(self.z_er_buf, float).reshape(n, -1)
+        self.slot_cam = np.frombuffer(self.cam_buf, self.cam_dtype).reshape(
+            (n, ) + self.cam_shape)
+        self.slot_ft = np.frombuffer(self.ft_buf,
+                                     float).reshape((n, ) + self.cam_shape)
+        self.slot_fstord = np.frombuffer(self.fstord_buf,
+                                         float).reshape(n, -1)
+        self.slot_mag = np.frombuffer(self.mag_buf, float).reshape(n, -1)
+        self.slot_wrapped = np.frombuffer(self.wrapped_buf,
+                                          float).reshape(n, -1)
+        self.slot_unwrapped = np.frombuffer(self.unwrapped_buf,
+                                            float).reshape(n, -1)
+        self.slot_meta = {
+            'fstord_ext': np.frombuffer(self.slot_fstord_ext,
+                                        float).reshape(n, 4),
+            'fstord_shape': np.frombuffer(self.slot_fstord_shape,
+                                          np.intc).reshape(n, 2),
+            'mag_ext': np.frombuffer(self.slot_mag_ext, float).reshape(n, 4),
+            'mag_shape': np.frombuffer(self.slot_mag_shape,
+                                       np.intc).reshape(n, 2),
+        }
+        self.slot = 0
+
+    # Frame buffers of the current slot. In the worker this is the slot
+    # claimed by begin_frame(), in the GUI the slot taken with acquire().
+    @property
+    def cam(self):
+        return self.slot_cam[self.slot]
+
+    @property
+    def ft(self):
+        return self.slot_ft[self.slot]
+
+    @property
+    def fstord(self):
+        return self.slot_fstord[self.slot]
+
+    @property
+    def mag(self):
+        return self.slot_mag[self.slot]
+
+    @property
+    def wrapped(self):
+        return self.slot_wrapped[self.slot]
+
+    @property
+    def unwrapped(self):
+        return self.slot_unwrapped[self.slot]
+
+    @property
+    def z_ms(self):
+        return self.slot_z_ms[self.slot]
+
+    @property
+    def z_er(self):
+        return self.slot_z_er[self.slot]
+
+    @property
+    def fstord_ext(self):
+        return self.slot_meta['fstord_ext'][self.slot]
+
+    @property
+    def fstord_shape(self):
+        return self.slot_meta['fstord_shape'][self.slot]
+
+    @property
+    def mag_ext(self):
+        return self.slot_meta['mag_ext'][self.slot]
+
+    @property
+    def mag_shape(self):
+        return self.slot_meta['mag_shape'][self.slot]
+
+    def begin_frame(self):
+        """Claim a slot for writing a new frame (worker side).
+
+        The slot is neither the latest complete frame nor the one being
+        displayed, so the GUI never reads a slot while it is overwritten.
+        The shapes and extents of the previous frame are carried over.
+
+        """
+        with self.slot_lock:
+            busy = (self.latest.value, self.reading.value)
+            slot = [i for i in range(self.nslots) if i not in busy][0]
+            self.slot_seq[slot] = -1
+        if busy[0] >= 0:
+            for v in self.slot_meta.values():
+                v[slot] = v[busy[0]]
+        self.slot = slot
+        return slot
+
+    def end_frame(self):
+        "Publish the slot claimed by `begin_frame()` as the latest frame"
+        self.frame_seq.value += 1
+        with self.slot_lock:
+            self.slot_seq[self.slot] = self.frame_seq.value
+            self.latest.value = self.slot
+        return self.frame_seq.value
+
+    def acquire(self):
+        """Pin the latest complete frame for reading (GUI side).
+
+        Returns the sequence number of the frame, which is -1 if no frame
+        has been published yet. Call `release()` when done.
+
+        """
+        with self.slot_lock:
+            slot = self.latest.value
+            self.reading.value = slot
+        if slot >= 0:
+            self.slot = slot
+            return self.slot_seq[slot]
+        else:
+            return -1
+
+    def release(self):
+        with self.slot_lock:
+            self.reading.value = -1
+
+    def fringe_out(self, names=('logf2', 'logf3', 'mag', 'wrapped',
+                                'unwrapped')):
+        "Output buffers for `FringeAnalysis.analyse()`"
+        bufs = {
+            'logf2': self.ft,
+            'logf3': self.fstord,
+            'mag': self.mag,
+            'wrapped': self.wrapped,
+            'unwrapped': self.unwrapped,
+        }
+        return {n: bufs[n] for n in names}
+
+    def detach(self, fringe):
+        """Copy the images of `fringe` that are views of the frame slots.
+
+        Call at the end of a run that used `fringe_out()`, as the slots are
+        recycled by the next run.
+
+        """
+        for n in ('logf2', 'logf3', 'mag', 'wrapped', 'unwrapped'):
+            a = getattr(fringe, n, None)
+            if isinstance(a, np.ndarray) and any(
+                    np.may_share_memory(a, b)
+                    for b in (self.slot_ft, self.slot_fstord, self.slot_mag,
+                              self.slot_wrapped, self.slot_unwrapped)):
+                setattr(fringe, n, a.copy())
 
     def get_phase(self):
-        nsum1 = self.fstord_shape[0] * self.fstord_shape[1]
-        fstord = np.frombuffer(self.fstord_buf, float,
-                               count=nsum1).reshape(self.fstord_shape)
-        nsum2 = self.mag_shape[0] * self.mag_shape[1]
-        mag = np.frombuffer(self.mag_buf, float,
-                            count=nsum2).reshape(self.mag_shape)
-        wrapped = np.frombuffer(self.wrapped_buf, float,
-                                count=nsum2).reshape(self.mag_shape)
-        unwrapped = np.frombuffer(self.unwrapped_buf, float,
-                                  count=nsum2).reshape(self.mag_shape)
+        """Copies of the phase images of the current slot.
+
+        Matplotlib keeps a reference to the images it shows, which must not
+        change once the slot is released and overwritten by the worker.
+
+        """
+        shape1 = tuple(self.fstord_shape)
+        fstord = self.fstord[:shape1[0] * shape1[1]].reshape(shape1).copy()
+        shape2 = tuple(self.mag_shape)
+        nsum2 = shape2[0] * shape2[1]
+        mag = self.mag[:nsum2].reshape(shape2).copy()
+        wrapped = self.wrapped[:nsum2].reshape(shape2).copy()
+        unwrapped = self.unwrapped[:nsum2].reshape(shape2).copy()
         return fstord, mag, wrapped, unwrapped
 
+    def start_run(self):
+        "Called by the GUI before starting a free-running loop"
+        self.stop.value = 0
+        self.running.value = 1
+
+    def request_stop(self):
+        self.stop.value = 1
+
+    def stop_requested(self):
+        return self.stop.value != 0
+
+    def is_running(self):
+        return self.running.value != 0
+
+    def publish(self, state):
+        "Publish the result of an iteration (worker side)"
+        data = pickle.dumps(state)
+        if len(data) > RESULT_SIZE:
+            data = pickle.dumps((str(state[0])[:RESULT_SIZE // 2], ))
+        seq = self.seq.value + 1
+        slot = seq % 2
+        off = slot * RESULT_SIZE
+        self.result_seq[slot] = -1
+        self.result_buf[off:off + len(data)] = data
+        self.result_len[slot] = len(data)
+        self.result_seq[slot] = seq
+        self.seq.value = seq
+
+    def finish_run(self, state=None):
+        "Publish the last result and terminate a loop (worker side)"
+        if state is not None:
+            self.publish(state)
+        self.running.value = 0
+
+    def get_latest(self):
+        "Get the sequence number and the newest result (GUI side)"
+        while True:
+            seq = self.seq.value
+            if seq == 0:
+                return 0, None
+            slot = seq % 2
+            off = slot * RESULT_SIZE
+            data = self.result_buf[off:off + self.result_len[slot]]
+            if self.result_seq[slot] == seq:
+                return seq, pickle.loads(data)
+
 
 def run_worker(shared, args):
     p = Worker(shared, args)
@@ -1670,7 +2007,8 @@ class Worker:
         self.log = logging.getLogger('Worker')
         dm = open_dm(None, args)
         cam = open_cam(None, args)
-        get_suitable_dmplot(args, dm)
+        dmplot = get_suitable_dmplot(args, dm)
+        make_sim_interf(args, cam, dm, dmplot)
         cam.set_exposure(cam.get_exposure_range()[0])
 
         shared.make_static()
@@ -1688,6 +2026,7 @@ class Worker:
         self.dm = dm
         self.shared = shared
         self.fringe = fringe
+        self.args = args
 
     def run(self):
         cam = self.cam
@@ -1739,9 +2078,6 @@ class Worker:
 
         self.log.info('dies')
 
-    def fill(self, dst, src):
-        dst[:src.nbytes] = src.tobytes()
-
     def run_align(self, auto, repeat, poke, sleep, unwrap):
         cam = self.cam
         dm = self.dm
@@ -1760,6 +2096,7 @@ class Worker:
                 dm.write(shared.u)
                 time.sleep(sleep)
 
+            shared.begin_frame()
             try:
                 img = cam.grab_image()  # copy immediately
                 shared.cam[:] = img[:]
@@ -1780,44 +2117,43 @@ class Worker:
                                    store_mag=True,
                                    store_wrapped=True,
                                    do_unwrap=unwrap,
-                                   use_mask=False)
+                                   use_mask=False,
+                                   out=shared.fringe_out())
                     elapsed = time.time() - ts1
                 except Exception:
                     state = ('ERR2', 'RETRY', 'Failed to detect first orders')
 
             if state[0] == 'OK' and unwrap:
                 try:
-                    shared.ft[:] = fringe.logf2[:]
                     shared.fxcfyc[:] = fringe.fxcfyc[:]
 
-                    self.fill(shared.fstord_buf, fringe.logf3)
                     for i in range(4):
                         shared.fstord_ext[i] = fringe.ext3[i] * 1000
                     shared.fstord_shape[:] = fringe.logf3.shape[:]
-                    self.fill(shared.mag_buf, fringe.mag)
-                    self.fill(shared.wrapped_buf, fringe.wrapped)
                     for i in range(4):
                         shared.mag_ext[i] = fringe.ext4[i] / 1000
                     shared.mag_shape[:] = fringe.mag.shape[:]
-                    self.fill(shared.unwrapped_buf, fringe.unwrapped)
                 except Exception:
                     state = ('ERR3', 'RETRY', 'Failed to unwrap phase')
+            shared.end_frame()
 
-            shared.oq.put(state)
-            stopcmd = shared.iq.get()[1]
-            shared.oq.put('')
-
+            stopcmd = shared.stop_requested() or (state[0] != 'OK'
+                                                   and state[1] == 'STOP')
             if not repeat or stopcmd:
                 self.log.debug(
                     f'run_align stop, repeat {repeat:}, stopcmd {stopcmd:}')
+                shared.finish_run(state)
                 break
             else:
-                elapsed = time.time() - ts1
-                if elapsed < sleep:
-                    self.log.debug(f'run_align repeat sleep={sleep - elapsed}')
-                    time.sleep(sleep - elapsed)
-                else:
-                    self.log.debug('run_align repeat')
+                shared.publish(state)
+
+            elapsed = time.time() - ts1
+            if elapsed < sleep:
+                self.log.debug(f'run_align repeat sleep={sleep - elapsed}')
+                time.sleep(sleep - elapsed)
+            else:
+                self.log.debug('run_align repeat')
+        shared.detach(fringe)
 
     def open_dset(self, dname):
         estr = None
@@ -1835,6 +2171,15 @@ class Worker:
                 self.dset = None
                 return -1
 
+            try:
+                check_h5_filters(self.dset['data/images'])
+            except ValueError as e:
+                self.shared.oq.put((str(e), ))
+                self.dset.close()
+                self.dfname = None
+                self.dset = None
+                return -1
+
             try:
                 img = self.dset['data/images'][0, ...]
                 shape1 = self.cam.shape()
@@ -1906,6 +2251,26 @@ class Worker:
                 return f
 
             notify_fun = make_notify()
+            phases, normal = self.get_dataacq_phases()
+            if phases is not None:
+                self.log.info('run_calibrate using the acquired phases')
+
+            ns = self.dset['data/U'].shape[1]
+            if ns * np.invert(self.fringe.mask).sum() * 8 > SCRATCH_SIZE:
+                scratch = path.dirname(path.abspath(dname))
+                self.log.info(f'run_calibrate scratch directory {scratch}')
+            else:
+                scratch = None
+
+            if self.args.calib_checkpoint:
+                checkpoint = path.splitext(dname)[0] + '-phases.h5'
+            else:
+                checkpoint = None
+
+            if 'data/HadamardDesign' in self.dset:
+                design = HadamardDesign.load_h5py(self.dset, 'data/')
+            else:
+                design = None
 
             calib = RegLSCalib()
             calib.calibrate(U=self.dset['data/U'][()],
@@ -1919,7 +2284,14 @@ class Worker:
                             dmplot=dmplot,
                             dname=dname,
                             hash1=hash1,
-                            status_cb=notify_fun)
+                            status_cb=notify_fun,
+                            phases=phases,
+                            normal=normal,
+                            checkpoint=checkpoint,
+                            keep_checkpoint=True,
+                            scratch=scratch,
+                            design=design,
+                            pupil_bin=self.args.calib_pupil_bin)
 
             now = datetime.now(timezone.utc)
             libver = 'latest'
@@ -1933,22 +2305,40 @@ class Worker:
                 write_h5_header(h5f, libver, now)
                 calib.save_h5py(h5f)
 
-            notify_fun(f'Saved {path.basename(h5fn)}; ' +
-                       f'Quality {calib.mvaf.mean():.2f}%',
+            quality = f'Quality {calib.mvaf.mean():.2f}%'
+            if calib.cvvaf is not None:
+                quality += f' (cross-validated {calib.cvvaf.mean():.2f}%)'
+            notify_fun(f'Saved {path.basename(h5fn)}; ' + quality,
                        cmd='OK',
                        m2=h5fn)
         except Exception as e:
             self.log.error('run_calibrate', exc_info=True)
             self.shared.oq.put(('ERR', 'Error: ' + str(e)))
 
-    def open_calib(self, dname):
+    def get_dataacq_phases(self):
+        "Phases extracted during the acquisition with the current aperture"
+        if 'data/NormalMatrices' not in self.dset:
+            return None, None
+        attrs = self.dset['data/phases'].attrs
+        fringe = self.fringe
+        if (fringe.centre is None
+                or not np.allclose(attrs['fxcfyc'], fringe.fxcfyc)
+                or not np.allclose(attrs['centre'], fringe.centre)
+                or not np.allclose(attrs['radius'], fringe.radius)):
+            return None, None
+        return (self.dset['data/phases'],
+                NormalMatrices.load_h5py(self.dset, 'data/'))
+
+    def open_calib(self, dname, notify=None):
+        if notify is None:
+            notify = self.shared.oq.put
         logging.debug(
             f'open_calib() INIT calib_name={self.calib_name} dname={dname}')
         if self.calib_name is None or self.calib_name != dname:
             with h5py.File(dname, 'r') as f:
                 if 'RegLSCalib' not in f:
-                    self.shared.oq.put((path.basename(dname) +
-                                        ' does not look like a calibration', ))
+                    notify((path.basename(dname) +
+                            ' does not look like a calibration', ))
 
                     self.calib_name = None
                     logging.debug(
@@ -1972,7 +2362,7 @@ class Worker:
                     if (shape1[0] != shape2[0] or shape1[1] != shape2[1]
                             or pxsize1[0] != pxsize2[0]
                             or pxsize1[1] != pxsize2[1] or dm1 != dm2):
-                        self.shared.oq.put(
+                        notify(
                             ('Configuration mismatch; Spawn new instance...',
                              dname))
 
@@ -2048,12 +2438,15 @@ class Worker:
             ind -= t1
         try:
             img = self.dset[addr + '/images'][ind, ...]
+            self.shared.begin_frame()
             fringe.analyse(img,
                            auto_find_orders=False,
                            store_mag=True,
                            store_wrapped=True,
                            do_unwrap=True,
-                           use_mask=radius > 0.)
+                           use_mask=radius > 0.,
+                           out=self.shared.fringe_out(
+                               ('wrapped', 'unwrapped')))
 
             if img.max() == self.cam.get_image_max():
                 self.shared.cam_sat.value = 1
@@ -2061,20 +2454,21 @@ class Worker:
                 self.shared.cam_sat.value = 0
             self.shared.cam[:] = img[:]
             self.shared.u[:] = self.dset[addr + '/U'][:, ind]
-            self.fill(self.shared.wrapped_buf, fringe.wrapped)
             for i in range(4):
                 self.shared.mag_ext[i] = fringe.ext4[i] / 1000
             self.shared.mag_shape[:] = fringe.mag.shape[:]
-            self.fill(self.shared.unwrapped_buf, fringe.unwrapped)
+            self.shared.end_frame()
+            self.shared.detach(fringe)
             self.shared.oq.put(('OK', ))
         except Exception as e:
             self.log.error('run_plot', exc_info=True)
             self.shared.oq.put((str(e), ))
 
-    def run_dataacq(self, wavelength, dmplot, pokemag, sleep):
+    def run_dataacq(self, wavelength, dmplot, pokemag, sleep, radius=0.):
         cam = self.cam
         dm = self.dm
         shared = self.shared
+        args = self.args
 
         Ualign = []
         align_names = []
@@ -2096,7 +2490,22 @@ class Worker:
         if dmsn:
             h5fn = dmsn + '_' + h5fn
 
-        U = make_normalised_input_matrix(dm.size(), 5, pokemag)
+        design = None
+        if args.dataacq_design == 'hadamard':
+            design = HadamardDesign(dm.size(), args.dataacq_scale * pokemag)
+            U = design.U
+        elif args.dataacq_design == 'random':
+            U = make_random_input_matrix(dm.size(), dm.size(),
+                                         args.dataacq_scale * pokemag)
+        else:
+            U = make_normalised_input_matrix(dm.size(), 5, pokemag)
+        try:
+            image_opts = get_image_dataset_options(cam.shape(),
+                                                   args.dataacq_compression)
+        except Exception as e:
+            self.log.error('run_dataacq', exc_info=True)
+            shared.finish_run((str(e), ))
+            return
 
         with h5py.File(h5fn, 'w', libver=libver) as h5f:
             write_h5_header(h5f, libver, now)
@@ -2123,8 +2532,11 @@ class Worker:
             h5f['data/U'] = U
             h5f['data/U'].dims[0].label = 'actuators'
             h5f['data/U'].dims[1].label = 'step'
+            if design is not None:
+                design.save_h5py(h5f, 'data/')
             h5f.create_dataset('data/images', (U.shape[1], ) + cam.shape(),
-                               dtype=cam.get_image_dtype())
+                               dtype=cam.get_image_dtype(),
+                               **image_opts)
             h5f['data/images'].dims[0].label = 'step'
             h5f['data/images'].dims[1].label = 'height'
             h5f['data/images'].dims[1].label = 'width'
@@ -2134,7 +2546,8 @@ class Worker:
             h5f['align/U'].dims[1].label = 'step'
             h5f.create_dataset('align/images',
                                (Ualign.shape[1], ) + cam.shape(),
-                               dtype=cam.get_image_dtype())
+                               dtype=cam.get_image_dtype(),
+                               **image_opts)
             h5f['align/images'].dims[0].label = 'step'
             h5f['align/images'].dims[1].label = 'height'
             h5f['align/images'].dims[1].label = 'width'
@@ -2143,57 +2556,170 @@ class Worker:
             tot = U.shape[1] + Ualign.shape[1]
             count = [0]
 
+            # the frames are written to the file by a separate thread so
+            # that the DM/camera cadence does not wait on HDF5
+            frames = queue.Queue(maxsize=args.dataacq_queue)
+            errors = []
+            normal = []
+
+            def write_frames():
+                for imaddr, i, img in iter(frames.get, None):
+                    if not errors:
+                        try:
+                            h5f[imaddr][i, ...] = img
+                            if imaddr == 'data/phases':
+                                normal[0].add(U[:, i], img)
+                        except Exception as e:
+                            self.log.error('run_dataacq write',
+                                           exc_info=True)
+                            errors.append(e)
+
+            writer = threading.Thread(target=write_frames, daemon=True)
+            writer.start()
+
+            # phases extracted while acquiring, see start_phases()
+            pool = []
+            pending = deque()
+
+            def start_phases(img_zero, img_centre):
+                try:
+                    fringe = FringeAnalysis(cam.shape(),
+                                            cam.get_pixel_size())
+                    fringe.analyse(img_zero,
+                                   auto_find_orders=True,
+                                   do_unwrap=True,
+                                   use_mask=False)
+                    fringe.estimate_aperture(img_zero, img_centre, radius)
+                    nphi = np.invert(fringe.mask).sum()
+                    h5f.create_dataset('data/phases', (U.shape[1], nphi),
+                                       dtype=float,
+                                       chunks=(1, nphi))
+                    h5f['data/phases'].dims[0].label = 'step'
+                    h5f['data/phases'].attrs['fxcfyc'] = fringe.fxcfyc
+                    h5f['data/phases'].attrs['centre'] = fringe.centre
+                    h5f['data/phases'].attrs['radius'] = fringe.radius
+                    normal.append(NormalMatrices(U.shape[0], nphi))
+                    pool.append(make_phase_pool(fringe))
+                except Exception:
+                    self.log.warning('run_dataacq phases disabled',
+                                     exc_info=True)
+
+            def collect_phases(wait=False):
+                while pending and (wait or pending[0][1].ready()):
+                    i, res = pending.popleft()
+                    try:
+                        frames.put(('data/phases', i, res.get()))
+                    except Exception:
+                        self.log.warning('run_dataacq phases disabled',
+                                         exc_info=True)
+                        pool.pop().terminate()
+                        pending.clear()
+
+            def stop_writer(remove=False):
+                if pool:
+                    pool[0].terminate()
+                frames.put(None)
+                writer.join()
+                if remove or errors:
+                    h5f.close()
+                    try:
+                        os.remove(h5fn)
+                    except OSError:
+                        pass
+
+            img_centre = None
+            last_preview = 0.
             todo = ((Ualign, 'align/images'), (U, 'data/images'))
             for U1, imaddr in todo:
                 for i in range(U1.shape[1]):
                     try:
+                        if errors:
+                            raise errors[0]
                         dm.write(U1[:, i])
                         time.sleep(sleep)
                         img = cam.grab_image()  # copy immediately
+                        frames.put((imaddr, i, img))
                     except Exception as e:
                         self.log.error('run_dataacq', exc_info=True)
-                        shared.oq.put((str(e), ))
+                        stop_writer(True)
+                        shared.finish_run((str(e), ))
                         return
-                    if img.max() == cam.get_image_max():
-                        shared.cam_sat.value = 1
-                    else:
-                        shared.cam_sat.value = 0
-                    h5f[imaddr][i, ...] = img
-                    shared.u[:] = U1[:, i]
-                    shared.cam[:] = img
-                    shared.oq.put(('OK', count[0], tot))
-                    self.log.debug('run_dataacq iteration')
 
-                    stopcmd = shared.iq.get()[1]
-                    shared.oq.put(('', ))
+                    if radius > 0:
+                        if (imaddr == 'align/images'
+                                and align_names[i] == 'centre'):
+                            img_centre = img
+                        elif imaddr == 'data/images':
+                            if i == 0 and img_centre is not None:
+                                start_phases(img, img_centre)
+                            if pool:
+                                pending.append(
+                                    (i, pool[0].apply_async(
+                                        extract_phase, (img, ))))
+                                collect_phases()
+
+                    now = time.time()
+                    if (now - last_preview >= args.dataacq_preview
+                            or count[0] == tot - 1):
+                        last_preview = now
+                        if img.max() == cam.get_image_max():
+                            shared.cam_sat.value = 1
+                        else:
+                            shared.cam_sat.value = 0
+                        shared.u[:] = U1[:, i]
+                        shared.begin_frame()
+                        shared.cam[:] = img
+                        shared.end_frame()
+                        shared.publish(('OK', count[0], tot))
+                    self.log.debug('run_dataacq iteration')
 
-                    if stopcmd:
+                    if shared.stop_requested():
                         self.log.debug('run_dataacq stop_cmd')
-                        h5f.close()
-                        try:
-                            os.remove(h5fn)
-                        except OSError:
-                            pass
+                        stop_writer(True)
+                        shared.finish_run(('stopped', ))
                         return
                     else:
                         self.log.debug('run_dataacq continue')
 
                     count[0] += 1
 
-        self.log.debug('run_dataacq finished')
-        shared.oq.put(('finished', h5fn))
+            collect_phases(True)
+            stop_writer()
+            if errors:
+                shared.finish_run((str(errors[0]), ))
+                return
+            if normal and normal[0].count == U.shape[1]:
+                normal[0].save_h5py(h5f, 'data/')
+            elif 'data/phases' in h5f:
+                del h5f['data/phases']
 
-    def run_loop(self, dname, flat, noflat_index, closed_loop, sleep):
-        if self.open_calib(dname):
+        self.log.debug('run_dataacq finished')
+        shared.finish_run(('finished', h5fn))
+
+    def run_loop(self,
+                 dname,
+                 flat,
+                 noflat_index,
+                 closed_loop,
+                 sleep,
+                 pipeline=1,
+                 zonal=False):
+        if self.open_calib(dname, self.shared.finish_run):
             return
 
         calib = self.calib
         fringe = self.calib.fringe
         cam = self.cam
         t1 = time.time()
-        dm = ZernikeControl(self.dm, calib)
+        if zonal:
+            closed_loop = True
+            dm = ZonalControl(self.dm, calib)
+        elif closed_loop:
+            dm = IntegratorControl(self.dm, calib)
+        else:
+            dm = ZernikeControl(self.dm, calib)
         t2 = time.time()
-        self.log.debug(f'run_loop() ZernikeControl {t2 - t1:.3f}')
+        self.log.debug(f'run_loop() {dm.__class__.__name__} {t2 - t1:.3f}')
         shared = self.shared
         shared.z_size.value = dm.ndof
 
@@ -2201,62 +2727,173 @@ class Worker:
         self.log.debug(f'run_loop() reflatten {noflat_index}')
         dm.flat_on = flat
 
-        for i in range(4):
-            self.shared.mag_ext[i] = fringe.ext4[i] / 1000
-        shared.mag_shape[:] = fringe.unwrapped.shape[:]
-        while True:
-            try:
-                t1 = time.time()
-                dm.write(self.shared.z_sp[:dm.ndof])
-                self.shared.u[:] = dm.u[:]
-                if dm.saturation:
-                    self.shared.dm_sat.value = 1
-                else:
-                    self.shared.dm_sat.value = 0
-                t2 = time.time()
-
-                time.sleep(sleep)
-                img = cam.grab_image()
-
-                t3 = time.time()
-                fringe.analyse(img, use_mask=True)
-                unwrapped = fringe.unwrapped
-                calib.apply_aperture_mask(unwrapped)
-                self.fill(shared.unwrapped_buf, unwrapped)
-                t4 = time.time()
-
-                t7 = time.time()
-                shared.z_ms[:dm.ndof] = calib.zernike_fit(unwrapped)
-                shared.z_ms[0] = 0
-                t8 = time.time()
-
-                self.log.debug(f'run_loop() s:{sleep:.3f} h:{t2 - t1:.3f} ' +
-                               f'u:{t4 - t3:.3f} p2:{t8 - t7:.3f}')
-
-            except Exception as e:
-                self.log.info('run_loop()', exc_info=True)
-                shared.oq.put((str(e), ))
-                return
+        # Zernike coefficients of the last zonal frame that was fitted
+        zonal_fit = {'count': 0, 'ms': np.zeros(dm.ndof)}
 
-            shared.oq.put(('OK', ))
+        def analyse(img, z_sp, t_meas):
+            # runs in the analysis thread, owns the frame slot of Shared
+            t3 = time.time()
+            shared.begin_frame()
+            for i in range(4):
+                shared.mag_ext[i] = fringe.ext4[i] / 1000
+            shared.mag_shape[:] = fringe.unwrapped.shape[:]
+            fringe.analyse(img,
+                           use_mask=True,
+                           out=shared.fringe_out(('unwrapped', )))
+            unwrapped = fringe.unwrapped
+            calib.apply_aperture_mask(unwrapped)
+            t4 = time.time()
+
+            if zonal:
+                # the phase goes straight to the controller, the Zernike
+                # coefficients are only fitted for display every few frames
+                ms = unwrapped[calib.zfm]
+                if zonal_fit['count'] % ZONAL_FIT_EVERY == 0:
+                    zms = calib.zernike_fit(unwrapped)
+                    zms[0] = 0
+                    zonal_fit['ms'] = zms[:dm.ndof]
+                zonal_fit['count'] += 1
+                shared.z_ms[:dm.ndof] = zonal_fit['ms']
+                np.subtract(z_sp, zonal_fit['ms'], shared.z_er[:dm.ndof])
+            else:
+                ms = calib.zernike_fit(unwrapped)
+                ms[0] = 0
+                shared.z_ms[:dm.ndof] = ms
+                np.subtract(z_sp, ms, shared.z_er[:dm.ndof])
+            shared.end_frame()
+            t5 = time.time()
+            return ms, t_meas, t4 - t3, t5 - t4
+
+        # frames grabbed but not yet consumed, the oldest is analysed while
+        # the DM settles and the next frames are grabbed
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=1)
+        measured = None
+        stopping = False
+        self.log.debug(f'run_loop() pipeline {pipeline}')
+        try:
+            while True:
+                try:
+                    if not stopping:
+                        t1 = time.time()
+                        z_sp = shared.z_sp[:dm.ndof].copy()
+                        if closed_loop:
+                            dm.set_setpoint(z_sp)
+                            if measured:
+                                dm.update(*measured)
+                            else:
+                                dm.update()
+                        else:
+                            dm.write(z_sp)
+                        shared.u[:] = dm.u[:]
+                        if dm.saturation:
+                            shared.dm_sat.value = 1
+                        else:
+                            shared.dm_sat.value = 0
+                        t2 = time.time()
 
-            stopcmd = shared.iq.get()[1]
-            shared.oq.put('')
+                        time.sleep(sleep)
+                        img = cam.grab_image()
+                        t_meas = time.perf_counter()
+                        pending.append(
+                            executor.submit(analyse, img, z_sp, t_meas))
+
+                    if len(pending) >= pipeline or (stopping and pending):
+                        ms, t_meas1, tu, tp = pending.popleft().result()
+                        measured = (ms, t_meas1)
+                        self.log.debug(
+                            f'run_loop() s:{sleep:.3f} h:{t2 - t1:.3f} ' +
+                            f'u:{tu:.3f} p2:{tp:.3f} q:{len(pending)}')
+                        if closed_loop and dm.count % 50 == 0:
+                            stats = dm.get_stats()
+                            self.log.info(
+                                f'run_loop() rate:{stats["rate"]:.2f} Hz ' +
+                                f'latency:{stats["latency"]:.3f} ' +
+                                f'max:{stats["latency_max"]:.3f} s')
+                    elif not stopping:
+                        continue
 
-            if stopcmd:
-                self.log.debug('run_loop() stopcmd')
-                return
-            else:
-                self.log.debug('run_loop() continue')
+                except Exception as e:
+                    self.log.info('run_loop()', exc_info=True)
+                    shared.finish_run((str(e), ))
+                    return
 
-        self.log.debug('run_loop() finished')
-        shared.oq.put(('finished', ))
+                if shared.stop_requested():
+                    stopping = True
+                if stopping and not pending:
+                    self.log.debug('run_loop() stopcmd')
+                    shared.finish_run(('stopped', ))
+                    return
+                elif not stopping:
+                    shared.publish(('OK', ))
+                    self.log.debug('run_loop() continue')
+        finally:
+            executor.shutdown(cancel_futures=True)
+            shared.detach(fringe)
+
+
+def get_image_dataset_options(shape, compression='none'):
+    """Keyword arguments of `create_dataset()` for a stack of images.
+
+    Each image is stored in its own chunk, optionally compressed with
+    `gzip` (level 1) or `lz4`. The latter requires `hdf5plugin`, which is
+    also needed to read the data back, see `check_h5_filters()`.
+
+    """
+    opts = {'chunks': (1, ) + tuple(shape)}
+    if compression == 'gzip':
+        opts['compression'] = 'gzip'
+        opts['compression_opts'] = 1
+    elif compression == 'lz4':
+        if hdf5plugin is None:
+            raise ValueError('lz4 compression requires hdf5plugin')
+        opts.update(hdf5plugin.LZ4())
+    elif compression != 'none':
+        raise ValueError(f'unknown compression {compression}')
+    return opts
+
+
+def add_dataacq_parameters(parser):
+    parser.add_argument('--calib-pupil-bin',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Fit the calibration on NxN binned pupil pixels')
+    parser.add_argument('--calib-checkpoint',
+                        action='store_true',
+                        help='Keep the extracted phases next to the dataset ' +
+                        'to resume or repeat calibrations')
+    parser.add_argument('--dataacq-design',
+                        choices=['poke', 'hadamard', 'random'],
+                        default='poke',
+                        help='Poke each actuator in turn or many at once')
+    parser.add_argument('--dataacq-scale',
+                        type=float,
+                        default=.15,
+                        metavar='SCALE',
+                        help='Magnitude of the hadamard and random designs ' +
+                        'relative to the poke magnitude')
+    parser.add_argument('--dataacq-compression',
+                        choices=['none', 'gzip', 'lz4'],
+                        default='none',
+                        help='Compression of the acquired images')
+    parser.add_argument('--dataacq-queue',
+                        type=int,
+                        default=16,
+                        metavar='N',
+                        help='Images waiting to be written to the file')
+    parser.add_argument('--dataacq-preview',
+                        type=float,
+                        default=.1,
+                        metavar='SEC',
+                        help='Minimum interval between previews')
 
 
 def config_like(args, h5):
     log = logging.getLogger('config_like')
     with h5py.File(h5, 'r') as h5:
         if 'dmplot/DMPlot' in h5:
+            check_h5_filters(h5['data/images'])
             args.sim_cam_shape = h5['data/images'][0, ...].shape
             args.sim_cam_pix_size = h5['cam/pixel_size'][()]
             log.info(
@@ -2292,6 +2929,7 @@ def main():
     add_log_parameters(parser)
     add_dm_parameters(parser)
     add_cam_parameters(parser)
+    add_dataacq_parameters(parser)
     parser.add_argument('--config-like',
                         type=argparse.FileType('rb'),
                         default=None,
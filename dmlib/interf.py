@@ -267,6 +267,23 @@ def estimate_aperture_centre(xv, yv, zero_mag, zero_phi, centre_mag,
     return np.array(cc2)
 
 
+def get_out(out, name, shape):
+    """Get a view of shape `shape` on the output buffer `out[name]`.
+
+    The buffer can be any contiguous array with at least `prod(shape)`
+    elements, e.g. a `numpy` view on a shared-memory buffer. Returns `None` if
+    no buffer was provided for `name`.
+
+    """
+    if out is None or name not in out:
+        return None
+    buf = out[name].reshape(-1)
+    n = int(np.prod(shape))
+    if buf.size < n:
+        raise ValueError(f'output buffer {name} is too small')
+    return buf[:n].reshape(shape)
+
+
 def call_unwrap(phase, mask=None, seed=None):
     if mask is not None:
         assert (mask.shape == phase.shape)
@@ -312,13 +329,29 @@ class FringeAnalysis:
                 store_wrapped=False,
                 do_unwrap=True,
                 use_mask=True,
-                seed=None):
+                seed=None,
+                out=None):
+        """Extract the phase from an interferogram.
+
+        The optional dictionary `out` maps the names `logf2`, `logf3`, `mag`,
+        `wrapped` and `unwrapped` to output buffers. The corresponding
+        results are written directly into these buffers and the attributes
+        of this object are views on them.
+
+        """
 
         self.img = img
         fimg = ft(img)
 
+        if out is not None:
+            store_logf2 = store_logf2 or 'logf2' in out
+            store_logf3 = store_logf3 or 'logf3' in out
+            store_mag = store_mag or 'mag' in out
+            store_wrapped = store_wrapped or 'wrapped' in out
+
         if store_logf2 or auto_find_orders or self.fxcfyc is None:
-            self.logf2 = np.log(np.abs(fimg))
+            logf2 = np.abs(fimg, out=get_out(out, 'logf2', fimg.shape))
+            self.logf2 = np.log(logf2, out=logf2)
         else:
             self.logf2 = None
 
@@ -334,7 +367,8 @@ class FringeAnalysis:
             assert (f3.shape == self.order_shape)
 
         if store_logf3:
-            self.logf3 = np.log(np.abs(f3))
+            logf3 = np.abs(f3, out=get_out(out, 'logf3', f3.shape))
+            self.logf3 = np.log(logf3, out=logf3)
         else:
             self.logf3 = None
 
@@ -342,8 +376,10 @@ class FringeAnalysis:
                                                       self.ft_grid[1])
 
         gp = ift(f4)
-        mag = np.abs(gp)
-        wrapped = np.arctan2(gp.imag, gp.real)
+        mag = np.abs(gp, out=get_out(out, 'mag', gp.shape))
+        wrapped = np.arctan2(gp.imag,
+                             gp.real,
+                             out=get_out(out, 'wrapped', gp.shape))
 
         if store_gp:
             self.gp = gp
@@ -366,7 +402,12 @@ class FringeAnalysis:
                 mask = (mag < edges[1]).reshape(mag.shape)
             else:
                 mask = self.mask
-            self.unwrapped = call_unwrap(wrapped, mask, seed=seed)
+            unwrapped = call_unwrap(wrapped, mask, seed=seed)
+            dst = get_out(out, 'unwrapped', unwrapped.shape)
+            if dst is not None:
+                dst[:] = unwrapped
+                unwrapped = dst
+            self.unwrapped = unwrapped
 
     @classmethod
     def load_h5py(cls, f, prepend=None):
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from numpy.linalg import LinAlgError, pinv
+from scipy.linalg import cho_solve, qr, solve_triangular
+from scipy.linalg.lapack import dpstrf
+
+LOG = logging.getLogger('linalg')
+
+# condition numbers above this are logged as warnings
+COND_WARN = 1e8
+# condition numbers above this are treated as rank deficient
+COND_MAX = 1e12
+
+
+def get_factorisations(obj):
+    "Get the dictionary caching factorisations of `obj`, e.g., a calibration"
+    try:
+        return obj.factorisations
+    except AttributeError:
+        obj.factorisations = {}
+        return obj.factorisations
+
+
+def cached(obj, key, fun):
+    "Get `key` from the factorisations of `obj`, computing it with `fun()`"
+    cache = get_factorisations(obj)
+    try:
+        return cache[key]
+    except KeyError:
+        cache[key] = fun()
+        return cache[key]
+
+
+def triangular_cond(R):
+    """Estimate the condition number of `R.T @ R` from a triangular factor.
+
+    The ratio of the diagonal entries of `R` is a lower bound of the
+    condition number of `R`. It is only a reliable estimate if `R` comes
+    from a factorisation with pivoting, whose diagonal is non-increasing and
+    reveals the numerical rank.
+
+    """
+    d = np.abs(np.diag(R))
+    if d.min() == 0.:
+        return np.inf
+    else:
+        return (d.max() / d.min())**2
+
+
+def check_cond(name, cond):
+    if cond > COND_WARN:
+        LOG.warning(f'{name}: condition number {cond:.2e}')
+    else:
+        LOG.debug(f'{name}: condition number {cond:.2e}')
+    return cond
+
+
+class SPDSolver:
+    """Solve `A @ X = B` for a symmetric positive definite `A`.
+
+    `A` is factorised once with a pivoted Cholesky, `A[p][:, p] = R.T @ R`,
+    and can be reused for multiple right-hand sides. If `A` is not
+    numerically positive definite or is rank deficient, the solver falls
+    back to the pseudo-inverse.
+
+    """
+    def __init__(self, A, name='SPDSolver'):
+        self.name = name
+        self.pinv = None
+        self.R = None
+        self.piv = None
+        try:
+            c, piv, rank, info = dpstrf(np.asarray(A, dtype=float), lower=0)
+            if info < 0:
+                raise ValueError(f'dpstrf: illegal argument {-info}')
+            elif rank < A.shape[0]:
+                raise LinAlgError('rank deficient')
+            self.R = np.triu(c)
+            self.piv = piv - 1
+            self.cond = triangular_cond(self.R)
+            if self.cond > COND_MAX:
+                raise LinAlgError('ill-conditioned')
+        except LinAlgError:
+            LOG.warning(f'{name}: not positive definite, using pinv')
+            self.R = None
+            self.piv = None
+            self.pinv = pinv(A)
+            self.cond = np.linalg.cond(A)
+        check_cond(name, self.cond)
+
+    def solve(self, B):
+        if self.pinv is None:
+            X = np.empty_like(B, dtype=float)
+            X[self.piv] = cho_solve((self.R, False), B[self.piv])
+            return X
+        else:
+            return np.dot(self.pinv, B)
+
+
+def pseudo_inverse(A, name='pseudo_inverse'):
+    """Moore-Penrose pseudo-inverse of a full rank matrix using QR.
+
+    Tall matrices are factorised with column pivoting as `A[:, p] = Q @ R`,
+    so that `pinv(A)[p] = R^-1 @ Q.T`, and wide matrices as `A.T[:, p] = Q
+    @ R`. The pivoting reveals the numerical rank, and rank deficient
+    matrices fall back to `numpy.linalg.pinv`.
+
+    """
+    wide = A.shape[0] < A.shape[1]
+    if wide:
+        A = A.T
+    Q, R, p = qr(A, mode='economic', pivoting=True)
+    cond = triangular_cond(R)
+    if cond > COND_MAX:
+        LOG.warning(f'{name}: rank deficient, using pinv')
+        X = pinv(A)
+        cond = np.linalg.cond(A)**2
+    else:
+        X = np.empty((A.shape[1], A.shape[0]))
+        X[p] = solve_triangular(R, Q.T, lower=False)
+    check_cond(name, cond)
+    if wide:
+        return X.T
+    else:
+        return X
+
+
+def fwht(X):
+    """Fast Walsh-Hadamard transform along the first axis of `X`.
+
+    Computes `scipy.linalg.hadamard(n) @ X` in place with `n log2(n)`
+    additions, where `n = X.shape[0]` must be a power of two and `X` must
+    be C contiguous. Returns `X`.
+
+    """
+    n = X.shape[0]
+    if n < 1 or n & (n - 1):
+        raise ValueError('X.shape[0] is not a power of two')
+    elif not X.flags.c_contiguous:
+        raise ValueError('X is not C contiguous')
+    Y = X.reshape(n, -1)
+    tmp = np.empty((n // 2, Y.shape[1]), dtype=X.dtype)
+    h = 1
+    while h < n:
+        Z = Y.reshape(n // (2 * h), 2, h, -1)
+        a, b = Z[:, 0], Z[:, 1]
+        t = tmp.reshape(a.shape)
+        np.copyto(t, a)
+        a += b
+        np.subtract(t, b, out=b)
+        h *= 2
+    return X
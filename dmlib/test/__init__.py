@@ -5,18 +5,59 @@ import os
 import numpy as np
 
 from imageio import imread
-from numpy.random import uniform
+from numpy.random import randint, uniform
 from skimage.transform import resize
 
+# decoded int3.tif and its resized versions keyed by shape
+_int3_cache = {}
+
+
+def _read_int3():
+    if 'raw' not in _int3_cache:
+        img = imread(os.path.join(os.path.dirname(__file__), 'int3.tif'))
+        assert (img.dtype == np.uint8)
+        _int3_cache['raw'] = img
+    return _int3_cache['raw']
+
+
+def _resize_int3(shape):
+    shape = (int(shape[0]), int(shape[1]))
+    if shape not in _int3_cache:
+        img = _read_int3()
+        img = resize(img, shape, mode='constant', anti_aliasing=False)
+        img *= 255 / img.max()
+        img = img.astype(np.uint8)
+        assert (img.dtype == np.uint8)
+        _int3_cache[shape] = img
+    return _int3_cache[shape]
+
+
+def _random_shifts(shape):
+    raw = _read_int3().shape
+    s0 = uniform(-200, 200) * shape[0] / raw[0]
+    s1 = uniform(-200, 200) * shape[1] / raw[1]
+    return int(np.round(s0)), int(np.round(s1))
+
 
 def load_int3(shape):
-    img = imread(os.path.join(
-        os.path.dirname(__file__), 'int3.tif'))
-    img = np.roll(img, int(np.round(uniform(-200, 200))), axis=0)
-    img = np.roll(img, int(np.round(uniform(-200, 200))), axis=1)
-    assert(img.dtype == np.uint8)
-    img = resize(img, shape, mode='constant', anti_aliasing=False)
-    img *= 255/img.max()
-    img = img.astype(np.uint8)
-    assert(img.dtype == np.uint8)
-    return img
+    """Get a randomly shifted copy of the test interferogram.
+
+    The image is decoded and resized only once per shape.
+
+    """
+    img = _resize_int3(shape)
+    return np.roll(img, _random_shifts(img.shape), axis=(0, 1))
+
+
+def make_int3_pool(shape, size=8):
+    "Precompute `size` randomly shifted test interferograms"
+    img = _resize_int3(shape)
+    pool = np.empty((size, ) + img.shape, dtype=img.dtype)
+    for i in range(size):
+        pool[i, ...] = np.roll(img, _random_shifts(img.shape), axis=(0, 1))
+    return pool
+
+
+def sample_int3_pool(pool):
+    "Get a copy of a random image from a pool made with `make_int3_pool`"
+    return pool[randint(pool.shape[0]), ...].copy()
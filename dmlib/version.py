@@ -0,0 +1,3 @@
+__version__='0'
+__date__=''
+__commit__=''
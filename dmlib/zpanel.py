@@ -5,6 +5,7 @@ import argparse
 import json
 import logging
 import sys
+import time
 from copy import deepcopy
 from datetime import datetime
 from os import path
@@ -17,7 +18,8 @@ from matplotlib.backends.backend_qt5agg import (FigureCanvas,
 from matplotlib.figure import Figure
 from matplotlib.gridspec import GridSpec
 from numpy.linalg import norm
-from PyQt5.QtCore import QMutex, Qt, pyqtSignal
+from PyQt5.QtCore import (QMutex, Qt, QThread, QTimer, QWaitCondition,
+                          pyqtSignal)
 from PyQt5.QtGui import QDoubleValidator, QIntValidator, QKeySequence
 from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox, QDialog,
                              QDoubleSpinBox, QErrorMessage, QFileDialog,
@@ -28,12 +30,15 @@ from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox, QDialog,
 from zernike import RZern
 
 from dmlib import control
-from dmlib.calibration import RegLSCalib
+from dmlib.calibration import RegLSCalib, set_cart_grid
 from dmlib.control import ZernikeControl, get_noll_indices
 from dmlib.core import (add_dm_parameters, add_log_parameters,
                         get_suitable_dmplot, open_dm, setup_logging)
 from dmlib.version import __version__
 
+# default maximum rate of the DM writes from DMWindow, in Hz
+DM_MAX_RATE = 30.
+
 
 class MyQDoubleValidator(QDoubleValidator):
     def setFixup(self, val):
@@ -379,6 +384,10 @@ class RelSlider:
 class ZernikePanel(QWidget):
 
     def_pars = {'zernike_labels': {}, 'shown_modes': 21}
+    # minimum interval between two redraws of the phase plot
+    redraw_ms = 40
+    # rank-one updates of the phase before recomputing it from scratch
+    max_phi_updates = 1000
 
     def __init__(self,
                  wavelength,
@@ -400,11 +409,18 @@ class ZernikePanel(QWidget):
         self.cb = None
         self.shape = (128, 128)
         self.P = 1
+        self.phi = None
+        self.phi_z = None
+        self.phi_P = None
+        self.phi_updates = 0
+        self.basis = None
+        self.background = None
 
-        self.rzern = RZern(n_radial)
         dd = np.linspace(-1, 1, self.shape[0])
         xv, yv = np.meshgrid(dd, dd)
-        self.rzern.make_cart_grid(xv, yv)
+        self.rzern = set_cart_grid(RZern(n_radial), xv, yv)
+        self.pupil = np.flatnonzero(np.isfinite(self.rzern.ZZ[:, 0]))
+        self.phi_vect = np.full(self.rzern.ZZ.shape[0], np.nan)
         self.rad_to_nm = wavelength / (2 * np.pi)
         self.callback = callback
         self.zernike_rows = []
@@ -421,11 +437,26 @@ class ZernikePanel(QWidget):
         self.figphi = FigureCanvas(Figure(figsize=(2, 2)))
         self.ax = self.figphi.figure.add_subplot(1, 1, 1)
         phi = self.rzern.matrix(self.rzern.eval_grid(np.dot(self.P, self.z)))
-        self.im = self.ax.imshow(phi, origin='lower')
+        self.im = self.ax.imshow(phi, origin='lower', animated=True)
         self.cb = self.figphi.figure.colorbar(self.im)
         self.cb.locator = ticker.MaxNLocator(nbins=5)
         self.cb.update_ticks()
+        self.cb.ax.set_animated(True)
         self.ax.axis('off')
+
+        def on_draw(event):
+            # the image and the colorbar are animated and left out of full
+            # redraws, so that they can be blitted over this background
+            fig = self.figphi.figure
+            self.background = self.figphi.copy_from_bbox(fig.bbox)
+            fig.draw_artist(self.im)
+            fig.draw_artist(self.cb.ax)
+
+        self.figphi.mpl_connect('draw_event', on_draw)
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(self.redraw_ms)
+        self.redraw_timer.timeout.connect(self.redraw_phi_plot)
         self.status = QLabel('')
         lay_phase.addWidget(self.figphi, 0, 0)
         lay_phase.addWidget(self.status, 1, 0)
@@ -615,22 +646,76 @@ class ZernikePanel(QWidget):
             slider.set_value(self.z[i])
             slider.unblock()
 
+    def update_phi(self):
+        """Update the phase at the pupil pixels, `self.phi`, after `self.z`.
+
+        When a single shown mode has changed since the last update, the phase
+        is updated with the matching column of `self.basis`. Otherwise, or
+        after `max_phi_updates` such updates, it is recomputed from scratch.
+
+        """
+        if self.phi is not None and self.phi_P is self.P:
+            dz = self.z - self.phi_z
+            changed = np.flatnonzero(dz)
+            if changed.size == 0:
+                return
+            elif (changed.size == 1 and changed[0] < len(self.zernike_rows)
+                  and self.phi_updates < self.max_phi_updates):
+                ind = changed[0]
+                if self.basis is None or self.basis.shape[1] <= ind:
+                    self.make_basis()
+                self.phi += dz[ind] * self.basis[:, ind]
+                self.phi_z[ind] = self.z[ind]
+                self.phi_updates += 1
+                return
+
+        if self.phi_P is not self.P:
+            self.basis = None
+        phi = self.rzern.eval_grid(np.dot(self.P, self.z))
+        self.phi = phi[self.pupil]
+        self.phi_z = self.z.copy()
+        self.phi_P = self.P
+        self.phi_updates = 0
+
+    def make_basis(self):
+        "Phase at the pupil pixels of each of the shown modes"
+        n = len(self.zernike_rows)
+        ZZ = self.rzern.ZZ
+        if np.isscalar(self.P):
+            B = self.P * ZZ[self.pupil, :n]
+        else:
+            B = np.dot(ZZ, self.P[:, :n])[self.pupil]
+        self.basis = np.asfortranarray(B)
+
     def update_phi_plot(self, run_callback=True):
-        phi = self.mul * self.rzern.matrix(
-            self.rzern.eval_grid(np.dot(self.P, self.z)))
-        inner = phi[np.isfinite(phi)]
-        min1 = inner.min()
-        max1 = inner.max()
+        self.update_phi()
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+
+        if self.callback and run_callback:
+            self.callback(self.z)
+
+    def redraw_phi_plot(self):
+        phi = self.mul * self.phi
+        min1 = phi.min()
+        max1 = phi.max()
         rms = self.mul * norm(self.z)
         self.status.setText(
             '{} [{: 03.2f} {: 03.2f}] {: 03.2f} PV {: 03.2f} RMS'.format(
                 self.units, min1, max1, max1 - min1, rms))
-        self.im.set_data(phi)
-        self.im.set_clim(inner.min(), inner.max())
-        self.figphi.figure.canvas.draw()
+        self.phi_vect[self.pupil] = phi
+        self.im.set_data(self.rzern.matrix(self.phi_vect))
+        self.im.set_clim(min1, max1)
 
-        if self.callback and run_callback:
-            self.callback(self.z)
+        canvas = self.figphi
+        if self.background is None:
+            canvas.draw()
+        else:
+            fig = canvas.figure
+            canvas.restore_region(self.background)
+            fig.draw_artist(self.im)
+            fig.draw_artist(self.cb.ax)
+            canvas.blit(fig.bbox)
 
 
 class PlotCoeffs(QDialog):
@@ -671,6 +756,92 @@ class PlotCoeffs(QDialog):
         l1.addWidget(frame)
 
 
+class DMWriter(QThread):
+    """Write the latest of a stream of Zernike vectors at a maximum rate.
+
+    `submit()` replaces any vector not yet written, so that only the most
+    recent one reaches the DM. Vectors are written by calling `write(z)` in
+    this thread at most `max_rate` times per second. The return value of the
+    last write is kept for `take_result()` and `sig_written` is emitted.
+
+    """
+
+    sig_written = pyqtSignal()
+
+    def __init__(self, write, max_rate=DM_MAX_RATE, parent=None):
+        super().__init__(parent)
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.write = write
+        self.max_rate = max_rate
+        self.mutex = QMutex()
+        self.cond = QWaitCondition()
+        self.pending = None
+        self.result = None
+        self.busy = False
+        self.stopped = False
+        self.last = 0.
+
+    def submit(self, z):
+        self.mutex.lock()
+        self.pending = z.copy()
+        self.cond.wakeAll()
+        self.mutex.unlock()
+
+    def flush(self):
+        "Wait until all the submitted vectors have been written"
+        self.mutex.lock()
+        while (self.pending is not None and not self.stopped) or self.busy:
+            self.cond.wait(self.mutex)
+        self.mutex.unlock()
+
+    def take_result(self):
+        "Result of the last write, or `None` if already taken"
+        self.mutex.lock()
+        result = self.result
+        self.result = None
+        self.mutex.unlock()
+        return result
+
+    def stop(self):
+        self.flush()
+        self.mutex.lock()
+        self.stopped = True
+        self.cond.wakeAll()
+        self.mutex.unlock()
+        self.wait()
+
+    def run(self):
+        self.mutex.lock()
+        while not self.stopped:
+            if self.pending is None:
+                self.cond.wait(self.mutex)
+                continue
+
+            wait = self.last + 1 / self.max_rate - time.monotonic()
+            if wait > 0:
+                # new submissions replace the pending vector meanwhile
+                self.cond.wait(self.mutex, int(np.ceil(1e3 * wait)))
+                continue
+
+            z = self.pending
+            self.pending = None
+            self.busy = True
+            self.mutex.unlock()
+            try:
+                result = self.write(z)
+            except Exception as ex:
+                self.log.error(f'failed to write the DM {str(ex)}')
+                result = None
+            self.last = time.monotonic()
+            self.mutex.lock()
+            self.busy = False
+            if result is not None:
+                self.result = result
+            self.cond.wakeAll()
+            self.sig_written.emit()
+        self.mutex.unlock()
+
+
 class DMWindow(QMainWindow):
 
     sig_acquire = pyqtSignal(tuple)
@@ -679,7 +850,14 @@ class DMWindow(QMainWindow):
     sig_unlock = pyqtSignal()
     sig_draw = pyqtSignal(tuple)
 
-    def __init__(self, app, dm, dmplot, calib, pars={}, parent=None):
+    def __init__(self,
+                 app,
+                 dm,
+                 dmplot,
+                 calib,
+                 pars={},
+                 parent=None,
+                 max_rate=DM_MAX_RATE):
         super().__init__(parent)
         self.log = logging.getLogger(self.__class__.__name__)
         self.can_close = True
@@ -716,20 +894,43 @@ class DMWindow(QMainWindow):
         ax, figact = make_figs()
         self.figact = figact
 
+        def show_u(u, saturation):
+            if saturation:
+                satind = 'SAT'
+            else:
+                satind = 'OK'
+            dmstatus.setText(f'u [{u.min():+0.3f} ' +
+                             f'{u.max():+0.3f}] {satind}')
+
+            self.dmplot.update(u)
+
+        def dm_write(z):
+            # runs in self.dmwriter
+            self.zcontrol.write(z)
+            return (self.zcontrol.u.copy(), self.zcontrol.saturation)
+
+        def make_written_hand():
+            def f():
+                # skip the results already drawn by a previous call
+                result = self.dmwriter.take_result()
+                if result is not None:
+                    show_u(*result)
+
+            return f
+
+        self.dmwriter = DMWriter(dm_write, max_rate, self)
+        self.dmwriter.sig_written.connect(make_written_hand())
+        self.dmwriter.start()
+
         def make_write_dm():
             def f(z, do_write=True):
-                # callback for zpanel
+                # callback for zpanel, the DM is written by self.dmwriter
                 if do_write:
-                    self.zcontrol.write(z)
-
-                if self.zcontrol.saturation:
-                    satind = 'SAT'
+                    self.dmwriter.submit(z)
                 else:
-                    satind = 'OK'
-                dmstatus.setText(f'u [{self.zcontrol.u.min():+0.3f} ' +
-                                 f'{self.zcontrol.u.max():+0.3f}] {satind}')
-
-                self.dmplot.update(self.zcontrol.u)
+                    # let the writer finish with zcontrol before reading it
+                    self.dmwriter.flush()
+                    show_u(self.zcontrol.u.copy(), self.zcontrol.saturation)
 
             return f
 
@@ -757,6 +958,7 @@ class DMWindow(QMainWindow):
         def make_select_cb():
             def f(e):
                 self.mutex.lock()
+                self.dmwriter.flush()
                 if e.inaxes is not None:
                     ind = self.dmplot.index_actuator(e.xdata, e.ydata)
                     if ind != -1:
@@ -793,6 +995,7 @@ class DMWindow(QMainWindow):
 
         def lock():
             self.mutex.lock()
+            self.dmwriter.flush()
             self.can_close = False
             for i in range(self.tabs.count()):
                 self.tabs.widget(i).setEnabled(False)
@@ -842,6 +1045,7 @@ class DMWindow(QMainWindow):
         def f():
             def f(t):
                 u = t[0]
+                self.dmwriter.flush()
                 self.zcontrol.u[:] = u
                 z = self.zcontrol.u2z()
                 self.zpanel.z[:] = z
@@ -864,6 +1068,7 @@ class DMWindow(QMainWindow):
         self.tabs.addTab(control_options, 'control')
 
     def instance_control(self):
+        self.dmwriter.flush()
         try:
             self.zcontrol = ZernikeControl(self.dm, self.calib,
                                            self.pars['ZernikeControl'])
@@ -889,6 +1094,7 @@ class DMWindow(QMainWindow):
             self.zpanel.load_parameters(self.pars['ZernikePanel'])
 
     def save_parameters(self, asflat=False):
+        self.dmwriter.flush()
         self.pars['ZernikeControl'] = self.zcontrol.save_parameters(
             asflat=asflat)
         self.pars['ZernikePanel'] = self.zpanel.save_parameters()
@@ -979,6 +1185,7 @@ class DMWindow(QMainWindow):
 
         def hand_flat():
             def f(b):
+                self.dmwriter.flush()
                 self.zcontrol.flat_on = b
                 self.write_dm(self.zpanel.z)
 
@@ -1045,6 +1252,7 @@ class DMWindow(QMainWindow):
         def plotf():
             def f():
                 self.mutex.lock()
+                self.dmwriter.flush()
                 p = PlotCoeffs()
                 p.set_data(self.zcontrol.u, self.zcontrol.z)
                 p.exec_()
@@ -1056,6 +1264,7 @@ class DMWindow(QMainWindow):
 
         def handle1(name, cb):
             def f(b):
+                self.dmwriter.flush()
                 self.control_options.update('ZernikeControl', name, b)
                 self.zcontrol.pars[name] = b
                 self.zcontrol.transform_pupil()
@@ -1072,6 +1281,7 @@ class DMWindow(QMainWindow):
             def f():
                 try:
                     f = float(lerotate.text())
+                    self.dmwriter.flush()
                     self.control_options.update('ZernikeControl', 'rotate', f)
                     self.zcontrol.pars['rotate'] = f
                     self.zcontrol.transform_pupil()
@@ -1132,6 +1342,7 @@ class DMWindow(QMainWindow):
 
     def closeEvent(self, event):
         if self.can_close:
+            self.dmwriter.stop()
             if self.app:
                 self.app.quit()
             else:
@@ -1151,6 +1362,11 @@ def add_arguments(parser):
                         default=None,
                         metavar='JSON',
                         help='Load a previous configuration file')
+    parser.add_argument('--dm-max-rate',
+                        type=float,
+                        default=DM_MAX_RATE,
+                        metavar='HZ',
+                        help='Maximum rate of the DM writes from the GUI')
 
 
 def load_parameters(app, args):
@@ -1246,7 +1462,12 @@ def new_zernike_window(app, args, pars={}):
 
     dmplot = get_suitable_dmplot(args, dm, calib)
 
-    zwindow = DMWindow(None, dm, dmplot, calib, pars)
+    zwindow = DMWindow(None,
+                       dm,
+                       dmplot,
+                       calib,
+                       pars,
+                       max_rate=args.dm_max_rate)
     zwindow.show()
 
     return zwindow
@@ -1284,7 +1505,12 @@ def main():
 
     dmplot = get_suitable_dmplot(args, dm, calib)
 
-    zwindow = DMWindow(app, dm, dmplot, calib, pars)
+    zwindow = DMWindow(app,
+                       dm,
+                       dmplot,
+                       calib,
+                       pars,
+                       max_rate=args.dm_max_rate)
     zwindow.show()
 
     sys.exit(app.exec_())
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from timeit import timeit
+
+import numpy as np
+from numpy.linalg import pinv
+
+from dmlib.linalg import SPDSolver, pseudo_inverse
+"""Benchmark the solvers in dmlib.linalg against numpy.linalg.pinv.
+
+Random influence matrices `H` are generated with the shape of a calibration
+with 351 Zernike polynomials (n_radial = 25) and the actuator counts of some
+common DMs. For each, the script times the computation of the control matrix
+`C` with and without regularisation, and the pseudo-inverse of `C` used by
+`ZernikeControl`, reporting the largest difference between the two paths.
+
+"""
+
+
+def bench(name, old, new, number=5):
+    t1 = timeit(old, number=number) / number
+    t2 = timeit(new, number=number) / number
+    err = np.abs(old() - new()).max()
+    print(f'  {name:<12} pinv {t1 * 1e3:8.2f} ms  ' +
+          f'linalg {t2 * 1e3:8.2f} ms  x{t1 / t2:5.1f}  err {err:.1e}')
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    nz = 351
+    lambda1 = 5e-3
+
+    for nu in (52, 69, 140, 952):
+        print(f'{nu} actuators')
+        H = rng.normal(size=(nz, nu))
+        stds = rng.uniform(size=nu)
+        stds -= stds.min()
+        stds /= stds.max()
+        M = lambda1 * np.diag(1 - stds) + np.dot(H.T, H)
+        C = SPDSolver(M).solve(H.T)
+
+        bench('regularised', lambda: np.dot(pinv(M), H.T),
+              lambda: SPDSolver(M).solve(H.T))
+        bench('pinv(H)', lambda: pinv(H), lambda: pseudo_inverse(H))
+        bench('pinv(C)', lambda: pinv(C), lambda: pseudo_inverse(C))
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from dmlib.calibration import RegLSCalib
+from dmlib.core import check_h5_filters
 from dmlib.interf import FringeAnalysis
 from h5py import File
 """Example about using dmlib to compute a calibration.
@@ -28,6 +29,8 @@ if __name__ == '__main__':  # necessary for multiprocessing
 
     # load the interferograms from the HDF5 file
     with File(fname, 'r') as f:
+        # lz4 compressed images need hdf5plugin
+        check_h5_filters(f['data/images'])
         align = f['align/images'][()]
         names = f['align/names'][()]
         if isinstance(names, bytes):
@@ -74,6 +74,7 @@ setup(name='dmlib',
       extras_require={
           'user interface': ['pyqt5'],
           'plot': ['matplotlib'],
+          'lz4': ['hdf5plugin'],
       },
       entry_points={
           'console_scripts': [